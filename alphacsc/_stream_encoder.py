@@ -0,0 +1,246 @@
+import time
+from collections import deque
+
+import numba
+import numpy as np
+
+from .utils.dictionary import get_D_shape
+from .utils.compute_constants import compute_DtD
+from .utils.coordinate_descent import _coordinate_descent_compiled, _STRATEGIES
+
+
+class StreamEncoder:
+    """Encode a signal sample by sample with a fixed dictionary.
+
+    The encoder runs the greedy locally greedy coordinate descent (LGCD) on
+    the codes of the last ``window`` atom lengths of the stream. When new
+    samples are pushed, beta (the gradient of the data fit) is extended to
+    the new valid times, warm-started from the current codes, and the
+    coordinate descent resumes on the active window. The codes older than
+    the window can no longer change: they are finalised and returned by
+    ``push``. Their contribution to the active codes is kept in beta.
+
+    DtD, and for rank-1 dictionaries the spatial patterns u, are computed
+    once and reused across pushes. With a rank-1 dictionary, only the
+    projection u.T x of the new samples is kept in the buffer of the last
+    n_times_atom - 1 samples.
+
+    Parameters
+    ----------
+    D : array, shape (n_atoms, n_channels + n_times_atom) or
+                     (n_atoms, n_channels, n_times_atom)
+        The dictionary, in rank-1 or in full rank form.
+    n_channels : int
+        Number of channels of the signal.
+    reg : float or array, shape (n_atoms,)
+        The regularization parameter, possibly per atom.
+    window : int
+        Number of atom lengths of codes optimised after each push. The codes
+        are finalised when they are window * n_times_atom times older than
+        the last valid time. Larger windows get closer to the codes of the
+        full signal, at a larger cost per push.
+    tol : float
+        Tolerance of the coordinate descent, relative to the standard
+        deviation of the samples received so far, as for solver_z='lgcd'.
+    max_iter : int
+        Maximal number of passes over the segments of the active window for
+        each push.
+    n_latencies : int
+        Number of push durations kept to compute the latency statistics.
+    DtD : array, shape (n_atoms, n_atoms, 2 * n_times_atom - 1) | None
+        Precomputed DtD of the dictionary. If None, it is computed.
+    """
+
+    def __init__(self, D, n_channels, reg, window=3, tol=1e-3, max_iter=100,
+                 n_latencies=10000, DtD=None):
+        self.n_atoms, self.n_channels, self.n_times_atom = get_D_shape(
+            D, n_channels)
+        if window < 1:
+            raise ValueError("window should be at least 1. Got {}."
+                             .format(window))
+
+        self.D = D = np.asarray(D, dtype=np.float64)
+        self.window = window
+        self.tol = tol
+        self.max_iter = max_iter
+
+        self.reg = np.empty(self.n_atoms)
+        self.reg[:] = np.ravel(reg)
+        if DtD is None:
+            DtD = compute_DtD(D, n_channels=n_channels)
+        self.DtD = np.ascontiguousarray(DtD, dtype=np.float64)
+        t0 = self.n_times_atom - 1
+        self.norm_Dk = self.DtD[np.arange(self.n_atoms),
+                                np.arange(self.n_atoms), t0].copy()
+
+        # With a rank-1 dictionary, the correlation DtX only needs the
+        # projection u.T x of the samples on the spatial patterns.
+        if D.ndim == 2:
+            self._proj = D[:, :n_channels]
+            self._kernel = D[:, n_channels:]
+        else:
+            self._proj = None
+            self._kernel = D
+
+        self.latencies = deque(maxlen=n_latencies)
+        self.reset()
+
+    def reset(self):
+        """Forget the samples received so far."""
+        n_rows = self.n_channels if self._proj is None else self.n_atoms
+        self._buffer = np.zeros((n_rows, 0))
+        self._z = np.zeros((self.n_atoms, 0))
+        self._beta = np.zeros((self.n_atoms, 0))
+        self._dz_opt = np.zeros((self.n_atoms, 0))
+
+        # running moments of the samples, for the tolerance
+        self._n_samples = 0
+        self._mean = 0.
+        self._m2 = 0.
+
+        # number of codes finalised so far
+        self.n_times_final = 0
+        self.latencies.clear()
+
+    def push(self, x):
+        """Encode new samples of the signal.
+
+        Parameters
+        ----------
+        x : array, shape (n_channels, n_samples)
+            The new samples.
+
+        Returns
+        -------
+        z_final : array, shape (n_atoms, n_times_final)
+            The codes that have been finalised by this push, following the
+            codes returned by the previous calls.
+        """
+        t_start = time.perf_counter()
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim != 2 or x.shape[0] != self.n_channels:
+            raise ValueError("x should be an array of shape (n_channels, "
+                             "n_samples) with n_channels={}. Got {}."
+                             .format(self.n_channels, x.shape))
+
+        self._update_moments(x)
+        self._extend(x)
+        self._solve()
+
+        n_final = max(0, self._z.shape[1]
+                      - self.window * self.n_times_atom)
+        z_final = self._finalise(n_final)
+        self.latencies.append(time.perf_counter() - t_start)
+        return z_final
+
+    def flush(self):
+        """Finalise and return all the codes of the active window.
+
+        Returns
+        -------
+        z_final : array, shape (n_atoms, n_times_final)
+            The remaining codes of the signal.
+        """
+        return self._finalise(self._z.shape[1])
+
+    def get_latency_stats(self):
+        """Statistics on the duration of the last pushes, in seconds.
+
+        Returns
+        -------
+        stats : dict
+            With keys 'n_pushes', 'mean', 'median', 'p95', 'p99' and 'max'.
+        """
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            latencies = np.full(1, np.nan)
+        return dict(n_pushes=len(self.latencies), mean=latencies.mean(),
+                    median=np.median(latencies),
+                    p95=np.percentile(latencies, 95),
+                    p99=np.percentile(latencies, 99), max=latencies.max())
+
+    def _update_moments(self, x):
+        # merge the moments of the new samples with Chan's formula
+        n, n_new = self._n_samples, x.size
+        if n_new == 0:
+            return
+        mean_new = x.mean()
+        delta = mean_new - self._mean
+        self._m2 += ((x - mean_new) ** 2).sum() + delta ** 2 * n * n_new / (
+            n + n_new)
+        self._mean += delta * n_new / (n + n_new)
+        self._n_samples = n + n_new
+
+    def _extend(self, x):
+        """Add the valid times of the new samples to the active window."""
+        if self._proj is not None:
+            x = self._proj @ x
+        self._buffer = np.concatenate([self._buffer, x], axis=1)
+
+        n_new = self._buffer.shape[1] - self.n_times_atom + 1
+        if n_new <= 0:
+            return
+        windows = np.lib.stride_tricks.sliding_window_view(
+            self._buffer, self.n_times_atom, axis=1)
+        if self._proj is not None:
+            DtX = np.einsum('kl,ktl->kt', self._kernel, windows)
+        else:
+            DtX = np.einsum('kcl,ctl->kt', self._kernel, windows)
+        self._buffer = self._buffer[:, n_new:].copy()
+
+        n_active = self._z.shape[1]
+        zeros = np.zeros((self.n_atoms, n_new))
+        self._z = np.concatenate([self._z, zeros], axis=1)
+        self._beta = np.concatenate([self._beta, -DtX], axis=1)
+        self._dz_opt = np.concatenate([self._dz_opt, zeros], axis=1)
+        _warm_start_beta(self._beta, self._dz_opt, self._z, self.DtD,
+                         self.norm_Dk, self.reg, n_active)
+
+    def _solve(self):
+        n_active = self._z.shape[1]
+        if n_active == 0:
+            return
+        n_times_atom = self.n_times_atom
+        n_times_seg = 2 * n_times_atom - 1
+        n_seg = n_active // n_times_seg + (n_active % n_times_seg != 0)
+        tol = self.tol * np.sqrt(self._m2 / self._n_samples)
+        empty = np.zeros((0, 0, 0))
+        _coordinate_descent_compiled(
+            self._z, self._beta, self._dz_opt, self.DtD, self.norm_Dk,
+            self.reg, tol, self.max_iter * n_seg, _STRATEGIES['greedy'],
+            n_seg, n_times_seg, n_active * self.n_atoms, n_times_atom,
+            False, self._z, 0, False, empty, empty, np.zeros((0, 0))
+        )
+
+    def _finalise(self, n_final):
+        z_final = self._z[:, :n_final].copy()
+        self._z = self._z[:, n_final:].copy()
+        self._beta = self._beta[:, n_final:].copy()
+        self._dz_opt = self._dz_opt[:, n_final:].copy()
+        self.n_times_final += n_final
+        return z_final
+
+
+@numba.njit(cache=True)
+def _warm_start_beta(beta, dz_opt, z, DtD, norm_Dk, reg,
+                     n_active):  # pragma: no cover
+    """Add the contribution of the active codes to the beta of the new times.
+
+    beta[:, n_active:] is -DtX on input. The codes of the last
+    n_times_atom - 1 active times overlap with the new times, the older
+    codes, active or finalised, do not contribute.
+    """
+    n_atoms, n_times_valid = z.shape
+    n_times_atom = (DtD.shape[2] + 1) // 2
+    for t0 in range(max(0, n_active - n_times_atom + 1), n_active):
+        for k0 in range(n_atoms):
+            if z[k0, t0] == 0:
+                continue
+            t_end = min(t0 + n_times_atom, n_times_valid)
+            for k in range(n_atoms):
+                for t in range(n_active, t_end):
+                    beta[k, t] += DtD[k, k0, t - t0 + n_times_atom - 1] * (
+                        z[k0, t0])
+    for k in range(n_atoms):
+        for t in range(n_active, n_times_valid):
+            dz_opt[k, t] = max(-beta[k, t] - reg[k], 0.) / norm_Dk[k]
@@ -1,8 +1,15 @@
+import shutil
+import tempfile
+import os.path as op
+
 import numpy as np
+from scipy import sparse
+from joblib import Parallel, dump, load
 
 from .utils import construct_X_multi
 from .utils.dictionary import get_D_shape
 from .update_z_multi import update_z_multi
+from .utils.compute_constants import compute_DtD
 from .utils.dictionary import (
     _patch_reconstruction_error, get_uv, get_lambda_max
 )
@@ -15,7 +22,7 @@ DEFAULT_TOL_Z = 1e-3
 
 def get_z_encoder_for(X, D_hat, n_atoms, n_times_atom, n_jobs,
                       solver='l-bfgs', solver_kwargs=dict(),
-                      reg=0.1):
+                      reg=0.1, sparse_z=False, dtype=np.float64):
     """
     Returns a z encoder for the required solver.
 
@@ -38,9 +45,19 @@ def get_z_encoder_for(X, D_hat, n_atoms, n_times_atom, n_jobs,
         The solver to use for the z update. Options are
         {{'l_bfgs' (default) | 'lgcd' | 'dicodile'}}.
     solver_kwargs : dict
-        Additional keyword arguments to pass to update_z_multi.
+        Additional keyword arguments to pass to update_z_multi. For
+        solver='lgcd', setting ``incremental_ztz=True`` updates the
+        statistics ztz and ztX of the previous codes during the coordinate
+        descent instead of recomputing them after each call to compute_z.
     reg : float
         The regularization parameter.
+    sparse_z : bool
+        If True, the codes z_hat are stored as a list of n_trials sparse
+        matrices of shape (n_atoms, n_times_valid). Only supported with the
+        'l-bfgs' and 'lgcd' solvers.
+    dtype : np.float64 | np.float32
+        Floating point precision of X, D_hat and z_hat in the z-step. Only
+        np.float64 is supported with the 'dicodile' solver.
 
     Returns
     -------
@@ -67,10 +84,16 @@ def get_z_encoder_for(X, D_hat, n_atoms, n_times_atom, n_jobs,
 
         return AlphaCSCEncoder(
             X, D_hat, n_atoms, n_times_atom, n_jobs,
-            solver, solver_kwargs, reg
+            solver, solver_kwargs, reg, sparse_z=sparse_z, dtype=dtype
         )
 
     elif solver == 'dicodile':
+        assert not sparse_z, (
+            "sparse_z is not supported with solver='dicodile'."
+        )
+        assert np.dtype(dtype) == np.float64, (
+            "Only dtype=np.float64 is supported with solver='dicodile'."
+        )
 
         return DicodileEncoder(
             X, D_hat, n_atoms, n_times_atom, n_jobs,
@@ -97,7 +120,8 @@ class BaseZEncoder:
         self.n_trials, self.n_channels, self.n_times = X.shape
         self.n_times_valid = self.n_times - self.n_times_atom + 1
 
-        self.XtX = np.dot(X.ravel(), X.ravel())
+        # accumulate in float64 even if X is float32
+        self.XtX = np.einsum('ijk,ijk->', X, X, dtype=np.float64)
 
     def compute_z(self):
         """
@@ -134,10 +158,15 @@ class BaseZEncoder:
         '''
         return compute_objective(D=D, constants=self.get_constants())
 
-    def get_cost(self):
+    def get_cost(self, trial_idx=None):
         """
         Computes the cost of the current sparse representation (z_hat)
 
+        Parameters
+        ----------
+        trial_idx : None or array of int
+            If not None, the cost is only computed on these trials.
+
         Returns
         -------
         cost: float
@@ -246,38 +275,103 @@ class BaseZEncoder:
 
 class AlphaCSCEncoder(BaseZEncoder):
     def __init__(self, X, D_hat, n_atoms, n_times_atom, n_jobs,
-                 solver, solver_kwargs, reg):
+                 solver, solver_kwargs, reg, sparse_z=False,
+                 dtype=np.float64):
+
+        self.dtype = np.dtype(dtype)
+        X = X.astype(self.dtype, copy=False)
+        D_hat = D_hat.astype(self.dtype, copy=False)
 
         super().__init__(
             X, D_hat, n_atoms, n_times_atom, n_jobs,  solver_kwargs, reg
         )
 
         self.solver = solver
+        self.sparse_z = sparse_z
+
+        # The worker pool and the memory mapped copy of X are only created
+        # when the encoder is used as a context manager.
+        self._parallel = None
+        self._temp_folder = None
+
+        # Private copy of the statistics (ztz, ztX) of self.z_hat, or None if
+        # they are unknown. They are used by get_cost to evaluate the
+        # objective without reconstructing the signal and, with
+        # solver_kwargs['incremental_ztz'], by compute_z to warm start the
+        # statistics, which are then only updated for the coordinates changed
+        # by the 'lgcd' solver.
+        self._z_hat_stats = None
+        # self.XtX can be replaced by the online estimators, keep the norm of
+        # X for get_cost.
+        self._XtX = self.XtX
 
         effective_n_atoms = self.D_hat.shape[0]
         self.z_hat = self._get_new_z_hat(effective_n_atoms)
+        self._update_DtD()
+
+    def _update_DtD(self):
+        """Compute the constant DtD used by the 'lgcd' solver, once per
+        dictionary instead of once per trial and per call to compute_z."""
+        self.DtD = None
+        if self.solver == 'lgcd':
+            self.DtD = compute_DtD(D=self.D_hat, n_channels=self.n_channels)
 
     def _get_new_z_hat(self, n_atoms):
         """
         Returns a array filed with 0 with the right size for sparse codes.
         """
+        if self.sparse_z:
+            return [sparse.csr_matrix((n_atoms, self.n_times_valid),
+                                      dtype=self.dtype)
+                    for _ in range(self.n_trials)]
         return np.zeros((
             self.n_trials, n_atoms, self.n_times_valid
-        ))
+        ), dtype=self.dtype)
 
-    def _compute_z_aux(self, X, z0, unbiased_z_hat):
+    def _compute_z_aux(self, X, z0, unbiased_z_hat, ztz=None, ztX=None):
         reg = self.reg if not unbiased_z_hat else 0
 
         return update_z_multi(
             X, self.D_hat, reg=reg, z0=z0, solver=self.solver,
             solver_kwargs=self.solver_kwargs, freeze_support=unbiased_z_hat,
-            n_jobs=self.n_jobs, return_ztz=True
+            n_jobs=self.n_jobs, return_ztz=True, sparse_z=self.sparse_z,
+            parallel=self._parallel, DtD=self.DtD, ztz=ztz, ztX=ztX,
+            dtype=self.dtype
         )
 
+    def __enter__(self):
+        self._parallel = Parallel(n_jobs=self.n_jobs)
+        self._parallel.__enter__()
+
+        # Put X in a memory mapped file once, so that the workers only
+        # receive a reference to it and do not unpickle each trial at every
+        # call of compute_z.
+        if self.n_jobs != 1 and not isinstance(self.X, np.memmap):
+            self._temp_folder = tempfile.mkdtemp(prefix='alphacsc_')
+            filename = op.join(self._temp_folder, 'X.mmap')
+            dump(self.X, filename)
+            self._X_in_memory = self.X
+            self.X = load(filename, mmap_mode='r')
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._parallel.__exit__(exc_type, exc_val, exc_tb)
+        self._parallel = None
+
+        if self._temp_folder is not None:
+            self.X = self._X_in_memory
+            del self._X_in_memory
+            shutil.rmtree(self._temp_folder, ignore_errors=True)
+            self._temp_folder = None
+
     def compute_z(self, unbiased_z_hat=False):
-        self.z_hat, self.ztz, self.ztX = self._compute_z_aux(self.X,
-                                                             self.z_hat,
-                                                             unbiased_z_hat)
+        ztz, ztX = None, None
+        if self.solver_kwargs.get('incremental_ztz', False):
+            ztz, ztX = self._z_hat_stats or (None, None)
+        self.z_hat, self.ztz, self.ztX = self._compute_z_aux(
+            self.X, self.z_hat, unbiased_z_hat, ztz=ztz, ztX=ztX)
+        self._z_hat_stats = (self.ztz.copy(), self.ztX.copy())
 
     def compute_z_partial(self, i0, alpha=.8):
         if not hasattr(self, 'ztz'):
@@ -287,19 +381,43 @@ class AlphaCSCEncoder(BaseZEncoder):
             self.ztX = np.zeros(
                 (self.n_atoms, self.n_channels, self.n_times_atom))
 
-        self.z_hat[i0], self.ztz_i0, self.ztX_i0 = self._compute_z_aux(
-            self.X[i0], self.z_hat[i0], unbiased_z_hat=False)
+        if self.sparse_z:
+            idx = np.arange(self.n_trials)[i0]
+            z_hat_i0, self.ztz_i0, self.ztX_i0 = self._compute_z_aux(
+                self.X[idx], [self.z_hat[i] for i in idx],
+                unbiased_z_hat=False)
+            for i, z_hat_i in zip(idx, z_hat_i0):
+                self.z_hat[i] = z_hat_i
+        else:
+            self.z_hat[i0], self.ztz_i0, self.ztX_i0 = self._compute_z_aux(
+                self.X[i0], self.z_hat[i0], unbiased_z_hat=False)
 
         self.ztz = alpha * self.ztz + self.ztz_i0
         self.ztX = alpha * self.ztX + self.ztX_i0
-
-    def get_cost(self):
-
-        X_hat = construct_X_multi(self.z_hat, D=self.D_hat,
-                                  n_channels=self.n_channels)
-
-        return compute_objective(X=self.X, X_hat=X_hat, z_hat=self.z_hat,
-                                 reg=self.reg)
+        self._z_hat_stats = None
+
+    def get_cost(self, trial_idx=None):
+        if trial_idx is None and self._z_hat_stats is not None:
+            # The statistics of z_hat are up to date, the data-fit term is
+            # computed in O(K^2 L^2 + K C L) from ztz, ztX and XtX.
+            ztz, ztX = self._z_hat_stats
+            constants = dict(n_channels=self.n_channels, XtX=self._XtX,
+                             ztz=ztz, ztX=ztX)
+            return compute_objective(D=self.D_hat, constants=constants,
+                                     z_hat=self.z_hat, reg=self.reg)
+
+        # Reconstruct the signal one trial at a time, so that the memory does
+        # not scale with the size of X.
+        if trial_idx is None:
+            trial_idx = range(self.n_trials)
+        cost = 0
+        for i in trial_idx:
+            z_hat = self.z_hat[i:i + 1]
+            X_hat = construct_X_multi(z_hat, D=self.D_hat,
+                                      n_channels=self.n_channels)
+            cost += compute_objective(X=self.X[i:i + 1], X_hat=X_hat,
+                                      z_hat=z_hat, reg=self.reg)
+        return cost
 
     def get_sufficient_statistics(self):
         assert hasattr(self, 'ztz') and hasattr(self, 'ztX'), (
@@ -332,19 +450,30 @@ class AlphaCSCEncoder(BaseZEncoder):
         n_channels = self.X.shape[1]
         *_, n_times_atom = get_D_shape(self.D_hat, n_channels)
 
-        patch = self.X[n0, :, t0:t0 + n_times_atom][None]
+        patch = self.X[n0, :, t0:t0 + n_times_atom][None].copy()
         if self.D_hat.ndim == 2:
             patch = get_uv(patch)
         return patch
 
     def set_D(self, D):
-        self.D_hat = D
+        self.D_hat = D.astype(self.dtype, copy=False)
+        self._update_DtD()
 
-        nb_missing_atoms = D.shape[0] - self.z_hat.shape[1]
+        if self.sparse_z:
+            nb_missing_atoms = D.shape[0] - self.z_hat[0].shape[0]
+        else:
+            nb_missing_atoms = D.shape[0] - self.z_hat.shape[1]
 
         assert nb_missing_atoms >= 0
-
         if nb_missing_atoms > 0:
+            self._z_hat_stats = None
+
+        if nb_missing_atoms > 0 and self.sparse_z:
+            self.z_hat = [
+                sparse.vstack([z_i, z_new], format='csr') for z_i, z_new
+                in zip(self.z_hat, self._get_new_z_hat(nb_missing_atoms))
+            ]
+        elif nb_missing_atoms > 0:
             self.z_hat = np.concatenate(
                 [self.z_hat, self._get_new_z_hat(nb_missing_atoms)], axis=1
             )
@@ -361,7 +490,10 @@ class AlphaCSCEncoder(BaseZEncoder):
         z_nnz : ndarray, shape (n_atoms,)
             Ratio of non-zero activations for each atom.
         """
-        z_nnz = np.sum(self.z_hat != 0, axis=(0, 2))
+        if self.sparse_z:
+            z_nnz = np.sum([z_i.getnnz(axis=1) for z_i in self.z_hat], axis=0)
+        else:
+            z_nnz = np.sum(self.z_hat != 0, axis=(0, 2))
         return z_nnz / z_nnz.shape[-1]
 
 
@@ -439,10 +571,15 @@ class DicodileEncoder(BaseZEncoder):
         raise NotImplementedError(
             "compute_z_partial is not available in DiCoDiLe")
 
-    def get_cost(self):
+    def get_cost(self, trial_idx=None):
         """
         Computes the cost of the current sparse representation (z_hat)
 
+        Parameters
+        ----------
+        trial_idx : None or array of int
+            Ignored, as dicodile only handles one trial.
+
         Returns
         -------
         cost: float
@@ -506,7 +643,7 @@ class DicodileEncoder(BaseZEncoder):
         n_channels = self.X.shape[1]
         *_, n_times_atom = get_D_shape(self.D_hat, n_channels)
 
-        patch = self.X[n0, :, t0:t0 + n_times_atom][None]
+        patch = self.X[n0, :, t0:t0 + n_times_atom][None].copy()
         if self.D_hat.ndim == 2:
             patch = get_uv(patch)
         return patch
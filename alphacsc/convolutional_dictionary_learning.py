@@ -4,6 +4,9 @@
 #          Alexandre Gramfort <alexandre.gramfort@inria.fr>
 #          Thomas Moreau <thomas.moreau@inria.fr>
 
+import numpy as np
+from scipy import sparse
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.base import TransformerMixin
 from sklearn.exceptions import NotFittedError
 
@@ -12,6 +15,9 @@ from .utils.dictionary import get_D, get_uv, flip_uv
 from .learn_d_z_multi import learn_d_z_multi
 from .loss_and_gradient import construct_X_multi
 from ._d_solver import check_solver_and_constraints
+from .utils.parallel import numba_threads
+from .utils.compute_constants import compute_DtD
+from ._stream_encoder import StreamEncoder
 
 
 DOC_FMT = """{short_desc}
@@ -63,6 +69,12 @@ DOC_FMT = """{short_desc}
         - :code:`'per_atom'`: the regularization parameter is set per atom and
           at each iteration as a ratio of its maximal value for this atom
           *i.e.* lambda[k] = reg * lmbd_max(uv_hat[k]).
+    monitor_every : int
+        The objective is evaluated, and the stopping criterion checked, every
+        monitor_every iterations and at the last iteration.
+    cost_sample : int or None
+        If not None, the objective is evaluated on a fixed random subset of
+        cost_sample trials instead of on all the trials.
 
 
     Z-step parameters
@@ -75,6 +87,15 @@ DOC_FMT = """{short_desc}
     unbiased_z_hat : boolean
         If set to True, the value of the non-zero coefficients in the returned
         z_hat are recomputed with reg=0 on the frozen support.
+    sparse_z : boolean
+        If set to True, the activations are stored and returned as a list of
+        n_trials sparse matrices of shape (n_atoms, n_times_valid), so memory
+        scales with the number of activations instead of the signal length.
+    dtype : np.float64 | np.float32
+        Floating point precision of the signals, the activations and the
+        atoms. With np.float32, the memory and bandwidth used by the z-step
+        are halved. The sufficient statistics and the D-step, whose sizes do
+        not depend on the signal length, are computed in float64.
 
 
     D-step parameters
@@ -94,7 +115,8 @@ DOC_FMT = """{short_desc}
     Technical parameters
 
     n_jobs : int
-        The number of parallel jobs.
+        The number of parallel jobs. It is also the number of threads used
+        by the numba kernels computing DtD, ztz and the D-step gradient.
     verbose : int
         The verbosity level.
     callback : func
@@ -140,7 +162,8 @@ class ConvolutionalDictionaryLearning(TransformerMixin):
                  alpha=.8, batch_size=1, batch_selection='random',
                  unbiased_z_hat=False, verbose=10, callback=None,
                  random_state=None, name="_CDL", raise_on_increase=True,
-                 sort_atoms=False):
+                 sort_atoms=False, sparse_z=False, dtype=np.float64,
+                 monitor_every=1, cost_sample=None):
 
         solver_d, uv_constraint = check_solver_and_constraints(
             rank1, solver_d, uv_constraint
@@ -161,11 +184,15 @@ class ConvolutionalDictionaryLearning(TransformerMixin):
         self.algorithm = algorithm
         self.algorithm_params = algorithm_params
         self.lmbd_max = lmbd_max
+        self.monitor_every = monitor_every
+        self.cost_sample = cost_sample
 
         # Z-step parameters
         self.solver_z = solver_z
         self.solver_z_kwargs = solver_z_kwargs
         self.unbiased_z_hat = unbiased_z_hat
+        self.sparse_z = sparse_z
+        self.dtype = dtype
 
         # D-step parameters
         self.solver_d = solver_d
@@ -182,6 +209,7 @@ class ConvolutionalDictionaryLearning(TransformerMixin):
 
         # Init property
         self._D_hat = None
+        self._DtD = None
 
     def fit(self, X, y=None):
         """Learn a convolutional dictionary from the set of signals X.
@@ -199,7 +227,9 @@ class ConvolutionalDictionaryLearning(TransformerMixin):
             unbiased_z_hat=False, verbose=self.verbose, callback=self.callback,
             random_state=self.random_state, n_jobs=self.n_jobs,
             name=self.name, raise_on_increase=self.raise_on_increase,
-            sort_atoms=self.sort_atoms
+            sort_atoms=self.sort_atoms, sparse_z=self.sparse_z,
+            dtype=self.dtype, monitor_every=self.monitor_every,
+            cost_sample=self.cost_sample
         )
 
         self._pobj, self._times, self._D_hat, self._z_hat, self.reg_ = res
@@ -221,6 +251,8 @@ class ConvolutionalDictionaryLearning(TransformerMixin):
                 X, self._D_hat, z0=z_hat, n_jobs=self.n_jobs,
                 reg=0, freeze_support=True,
                 solver=self.solver_z, solver_kwargs=self.solver_z_kwargs,
+                sparse_z=self.sparse_z, DtD=self._get_DtD(),
+                dtype=self.dtype
             )
             if self.verbose > 0:
                 print("done")
@@ -234,6 +266,8 @@ class ConvolutionalDictionaryLearning(TransformerMixin):
         z_hat, _, _ = update_z_multi(
             X, self._D_hat, reg=self.reg_, n_jobs=self.n_jobs,
             solver=self.solver_z, solver_kwargs=self.solver_z_kwargs,
+            sparse_z=self.sparse_z, DtD=self._get_DtD(),
+            dtype=self.dtype
         )
 
         if self.unbiased_z_hat:
@@ -244,16 +278,158 @@ class ConvolutionalDictionaryLearning(TransformerMixin):
                 X, self._D_hat, z0=z_hat, n_jobs=self.n_jobs,
                 reg=0, freeze_support=True,
                 solver=self.solver_z, solver_kwargs=self.solver_z_kwargs,
+                sparse_z=self.sparse_z, DtD=self._get_DtD(),
+                dtype=self.dtype
             )
             if self.verbose > 0:
                 print("done")
         return z_hat
 
+    def transform_chunks(self, X, chunk_size, overlap=None):
+        """Encode a long signal chunk by chunk, with bounded memory.
+
+        The valid times of the codes are split in consecutive chunks of
+        ``chunk_size`` samples (the last one absorbs the remainder). Each
+        chunk is encoded on a window extended by ``overlap`` samples on both
+        sides, so that the atoms crossing its boundaries are explained. The
+        seams are then resolved by re-optimising the codes within ``overlap``
+        samples of each boundary, with the codes of both neighbouring chunks
+        fixed. The chunks of a batch of n_jobs chunks are encoded, and their
+        seams resolved, in parallel.
+
+        Only the chunks being processed are kept in memory, so X can be a
+        ``np.memmap`` of a recording too large to be encoded at once.
+        Contrary to ``transform``, the codes are not refitted when
+        ``unbiased_z_hat=True``.
+
+        Parameters
+        ----------
+        X : array, shape (n_channels, n_times) or (1, n_channels, n_times)
+            The signal to encode.
+        chunk_size : int
+            Number of valid times of the codes in each chunk. It should be
+            at least ``2 * overlap + n_times_atom - 1``.
+        overlap : int | None
+            Number of samples added on each side of a chunk to encode it, and
+            half size of the seams. It should be at least n_times_atom. If
+            None, it is set to n_times_atom.
+
+        Yields
+        ------
+        z_chunk : sparse matrix, shape (n_atoms, n_times_chunk)
+            CSR matrix with the codes of the next chunk.
+            ``scipy.sparse.hstack`` of all the chunks gives the codes of the
+            full signal, of shape (n_atoms, n_times - n_times_atom + 1).
+        """
+        self._check_fitted()
+        if X.ndim == 3:
+            if X.shape[0] != 1:
+                raise ValueError("transform_chunks encodes a single signal. "
+                                 "Got X with {} trials.".format(X.shape[0]))
+            X = X[0]
+
+        n_times_atom = self.n_times_atom
+        if overlap is None:
+            overlap = n_times_atom
+        if overlap < n_times_atom:
+            raise ValueError("overlap should be at least n_times_atom={}. "
+                             "Got {}.".format(n_times_atom, overlap))
+        if chunk_size < 2 * overlap + n_times_atom - 1:
+            raise ValueError("chunk_size should be at least 2 * overlap + "
+                             "n_times_atom - 1 = {}. Got {}.".format(
+                                 2 * overlap + n_times_atom - 1, chunk_size))
+
+        n_times_valid = X.shape[1] - n_times_atom + 1
+        n_chunks = max(1, n_times_valid // chunk_size)
+        bounds = [i * chunk_size for i in range(n_chunks)] + [n_times_valid]
+
+        z_kwargs = dict(reg=self.reg_, solver=self.solver_z,
+                        solver_kwargs=self.solver_z_kwargs,
+                        DtD=self._get_DtD(), dtype=self.dtype)
+        batch_size = effective_n_jobs(self.n_jobs)
+
+        pending = None
+        with Parallel(n_jobs=self.n_jobs) as parallel:
+            for i in range(0, n_chunks, batch_size):
+                batch = range(i, min(i + batch_size, n_chunks))
+                windows = [(max(0, bounds[j] - overlap),
+                            min(n_times_valid, bounds[j + 1] + overlap))
+                           for j in batch]
+                z_windows = parallel(
+                    delayed(update_z_multi)(
+                        X[None, :, start:stop + n_times_atom - 1],
+                        self._D_hat, n_jobs=1, **z_kwargs)
+                    for start, stop in windows)
+                z_chunks = [
+                    z_window[0, :, bounds[j] - start:bounds[j + 1] - start]
+                    for j, (start, stop), (z_window, _, _) in zip(
+                        batch, windows, z_windows)
+                ]
+                if pending is not None:
+                    z_chunks.insert(0, pending)
+
+                # The seams are far enough from each other to be
+                # re-optimised independently.
+                seams = [b for b in bounds[i:batch[-1] + 1] if b > 0]
+                z_seams = parallel(
+                    delayed(_solve_seam)(
+                        X, self._D_hat, z_left, z_right, seam, overlap,
+                        z_kwargs)
+                    for seam, z_left, z_right in zip(seams, z_chunks[:-1],
+                                                     z_chunks[1:]))
+                for z_left, z_right, z_seam in zip(z_chunks[:-1],
+                                                   z_chunks[1:], z_seams):
+                    z_left[:, -overlap:] = z_seam[:, :overlap]
+                    z_right[:, :overlap] = z_seam[:, overlap:]
+
+                # The last chunk of the batch waits for its right seam.
+                pending = z_chunks.pop()
+                for z_chunk in z_chunks:
+                    yield sparse.csr_matrix(z_chunk)
+
+        yield sparse.csr_matrix(pending)
+
+    def get_stream_encoder(self, window=3, tol=1e-3, max_iter=100):
+        """Return an encoder of streamed samples with the learned dictionary.
+
+        Parameters
+        ----------
+        window : int
+            Number of atom lengths of codes optimised after each push.
+        tol : float
+            Tolerance of the coordinate descent.
+        max_iter : int
+            Maximal number of passes over the active window for each push.
+
+        Returns
+        -------
+        encoder : StreamEncoder
+            The encoder, see ``alphacsc._stream_encoder.StreamEncoder``.
+        """
+        self._check_fitted()
+        return StreamEncoder(self._D_hat, self.n_channels_, self.reg_,
+                             window=window, tol=tol, max_iter=max_iter,
+                             DtD=self._get_DtD())
+
     def transform_inverse(self, z_hat):
         """Reconstruct the signals from the given sparse codes.
         """
         return construct_X_multi(z_hat, self._D_hat, self.n_channels_)
 
+    def _get_DtD(self):
+        """Return DtD for the current dictionary, used by the 'lgcd' solver.
+
+        The value is cached and only recomputed when the dictionary changes.
+        """
+        if self.solver_z != 'lgcd':
+            return None
+        if self._DtD is None or not np.array_equal(self._DtD_D, self._D_hat):
+            self._DtD_D = self._D_hat.copy()
+            with numba_threads(self.n_jobs):
+                self._DtD = compute_DtD(self._D_hat,
+                                        n_channels=self.n_channels_)
+        return self._DtD
+
     def _check_fitted(self):
         if self._D_hat is None:
             raise NotFittedError("Fit must be called before accessing the "
@@ -341,12 +517,16 @@ class BatchCDL(ConvolutionalDictionaryLearning):
                  solver_d='auto', solver_d_kwargs={},
                  rank1=True, window=False, uv_constraint='auto',
                  lmbd_max='scaled', eps=1e-10, D_init=None,
-                 verbose=10, random_state=None, sort_atoms=False):
+                 verbose=10, random_state=None, sort_atoms=False,
+                 sparse_z=False, dtype=np.float64, monitor_every=1,
+                 cost_sample=None):
         super().__init__(
             n_atoms, n_times_atom, reg=reg, n_iter=n_iter,
             solver_z=solver_z, solver_z_kwargs=solver_z_kwargs,
             rank1=rank1, window=window, uv_constraint=uv_constraint,
             unbiased_z_hat=unbiased_z_hat, sort_atoms=sort_atoms,
+            sparse_z=sparse_z, dtype=dtype, monitor_every=monitor_every,
+            cost_sample=cost_sample,
             solver_d=solver_d, solver_d_kwargs=solver_d_kwargs,
             eps=eps, D_init=D_init,
             algorithm='batch', lmbd_max=lmbd_max, raise_on_increase=True,
@@ -368,15 +548,64 @@ class GreedyCDL(ConvolutionalDictionaryLearning):
                  solver_d='auto', solver_d_kwargs={},
                  rank1=True, window=False, uv_constraint='auto',
                  lmbd_max='scaled', eps=1e-10, D_init=None,
-                 verbose=10, random_state=None, sort_atoms=False):
+                 verbose=10, random_state=None, sort_atoms=False,
+                 sparse_z=False, dtype=np.float64, monitor_every=1,
+                 cost_sample=None):
         super().__init__(
             n_atoms, n_times_atom, reg=reg, n_iter=n_iter,
             solver_z=solver_z, solver_z_kwargs=solver_z_kwargs,
             rank1=rank1, window=window, uv_constraint=uv_constraint,
             unbiased_z_hat=unbiased_z_hat, sort_atoms=sort_atoms,
+            sparse_z=sparse_z, dtype=dtype, monitor_every=monitor_every,
+            cost_sample=cost_sample,
             solver_d=solver_d, solver_d_kwargs=solver_d_kwargs,
             eps=eps, D_init=D_init,
             algorithm='greedy', lmbd_max=lmbd_max, raise_on_increase=True,
             n_jobs=n_jobs, verbose=verbose, callback=None,
             random_state=random_state, name="GreedyCDL"
         )
+
+
+def _solve_seam(X, D, z_left, z_right, seam, overlap, z_kwargs):
+    """Re-optimise the codes within overlap samples of a chunk boundary.
+
+    The codes of the neighbouring chunks are fixed, so the seam codes only
+    have to explain the residual of the signal around the boundary.
+
+    Parameters
+    ----------
+    X : array, shape (n_channels, n_times)
+        The encoded signal.
+    D : array, shape (n_atoms, n_channels + n_times_atom) or
+                     (n_atoms, n_channels, n_times_atom)
+        The dictionary.
+    z_left, z_right : arrays, shape (n_atoms, n_times_chunk)
+        The codes of the chunks on both sides of the boundary.
+    seam : int
+        Position of the boundary in the valid times of the codes.
+    overlap : int
+        Half size of the re-optimised seam.
+    z_kwargs : dict
+        Parameters passed to update_z_multi.
+
+    Returns
+    -------
+    z_seam : array, shape (n_atoms, 2 * overlap)
+        The codes of the seam, from ``seam - overlap`` to ``seam + overlap``.
+    """
+    n_channels = X.shape[0]
+    n_times_atom = D.shape[-1] - n_channels if D.ndim == 2 else D.shape[-1]
+    context = overlap + n_times_atom - 1
+
+    z_local = np.concatenate([z_left[:, -context:], z_right[:, :context]],
+                             axis=1)
+    z0 = z_local[:, n_times_atom - 1:n_times_atom - 1 + 2 * overlap].copy()
+    z_local[:, n_times_atom - 1:n_times_atom - 1 + 2 * overlap] = 0
+    X_fixed = construct_X_multi(z_local[None], D, n_channels=n_channels)[0]
+
+    n_times_seam = 2 * overlap + n_times_atom - 1
+    residual = X[:, seam - overlap:seam - overlap + n_times_seam] - X_fixed[
+        :, n_times_atom - 1:n_times_atom - 1 + n_times_seam]
+    z_seam, _, _ = update_z_multi(residual[None], D, z0=z0[None], n_jobs=1,
+                                  **z_kwargs)
+    return z_seam[0]
@@ -7,12 +7,17 @@
 from __future__ import print_function
 import time
 import sys
+import shutil
+import weakref
+import tempfile
+import os.path as op
 
 import numpy as np
 
 from .utils import check_dimension
 from .utils import check_random_state
 from .utils.convolution import sort_atoms_by_explained_variances
+from .utils.parallel import numba_threads
 from ._z_encoder import get_z_encoder_for
 from ._d_solver import get_solver_d
 
@@ -27,13 +32,18 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
                     unbiased_z_hat=False, stopping_pobj=None,
                     raise_on_increase=True, verbose=10, callback=None,
                     random_state=None, name="DL", window=False,
-                    sort_atoms=False):
+                    sort_atoms=False, sparse_z=False, dtype=np.float64,
+                    monitor_every=1, cost_sample=None):
     """Multivariate Convolutional Sparse Coding with optional rank-1 constraint
 
     Parameters
     ----------
     X : array, shape (n_trials, n_channels, n_times)
-        The data on which to perform CSC.
+        The data on which to perform CSC. It can be a np.memmap or a lazily
+        loaded array supporting ``X[i]`` (e.g. a h5py dataset). In this case,
+        X is normalized one trial at a time into a temporary memory mapped
+        file, from which the z-step workers read their trials, so that the
+        memory does not scale with the size of the dataset.
     n_atoms : int
         The number of atoms to learn.
     n_times_atom : int
@@ -53,7 +63,8 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
     n_iter : int
         The number of coordinate-descent iterations.
     n_jobs : int
-        The number of parallel jobs.
+        The number of parallel jobs. It is also the number of threads used
+        by the numba kernels computing DtD, ztz and the D-step gradient.
 
     rank1 : boolean
         If set to True, learn rank 1 dictionary atoms.
@@ -65,7 +76,8 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
         If rank1 is False, then uv_constraint must be 'auto'.
     eps : float
         Stopping criterion. If the cost descent after a uv and a z update is
-        smaller than eps, return.
+        smaller than eps, return. With monitor_every > 1, the descent after
+        the z update is measured since the previous evaluation.
     algorithm : 'batch' | 'greedy' | 'online' | 'stochastic'
         Dictionary learning algorithm.
     algorithm_params : dict
@@ -119,6 +131,29 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
         If True, re-parametrizes the atoms with a temporal Tukey window
     sort_atoms : boolean
         If True, the atoms are sorted by explained variances.
+    sparse_z : boolean
+        If True, z_hat is stored and returned as a list of n_trials sparse
+        matrices of shape (n_atoms, n_times_valid).
+    dtype : np.float64 | np.float32
+        Floating point precision of X, z_hat and D_hat. With np.float32, the
+        z-step works in single precision, while the sufficient statistics are
+        accumulated in float64 and the D-step, whose cost does not depend on
+        the signal length, is solved in float64.
+    monitor_every : int
+        The objective is evaluated, and the stopping criterion checked, every
+        monitor_every iterations and at the last iteration. The entries of
+        pobj and times are then separated by monitor_every iterations, and
+        each entry of times includes the duration of the skipped iterations.
+    cost_sample : int or None
+        If not None, the objective is evaluated on a fixed random subset of
+        cost_sample trials instead of on all the trials. For the batch
+        algorithms, the full objective is already cheap to evaluate from the
+        sufficient statistics, this is mostly useful for online learning.
+        As the updates do not necessarily decrease the objective on the
+        subset, raise_on_increase is then ignored, the algorithm stops when
+        the relative changes of the objective are smaller than eps in
+        absolute value, and stopping_pobj is compared to the objective
+        rescaled by n_trials / cost_sample.
 
     Returns
     -------
@@ -129,7 +164,8 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
     uv_hat : array, shape (n_atoms, n_channels + n_times_atom)
         The atoms to learn from the data.
     z_hat : array, shape (n_trials, n_atoms, n_times_valid)
-        The sparse activation matrix.
+        The sparse activation matrix. If sparse_z is True, list of n_trials
+        sparse matrices of shape (n_atoms, n_times_valid).
     reg : float
         Regularization parameter used.
     """
@@ -142,8 +178,14 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
     _, n_channels, _ = check_dimension(X)
 
     # Rescale the problem to avoid underflow issues
-    std_X = X.std()
-    X = X / std_X
+    std_X = _get_std(X)
+    if isinstance(X, np.memmap) or not isinstance(X, np.ndarray):
+        # Out-of-core signal, the normalized signal is written trial by
+        # trial to a temporary memory mapped file.
+        X = _normalize_to_memmap(X, std_X, dtype)
+    else:
+        X = X.astype(dtype)
+        X /= std_X
 
     if algorithm == "stochastic":
         # The typical stochastic algorithm samples one signal, compute the
@@ -175,24 +217,31 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
 
     z_kwargs = dict(verbose=verbose, **solver_z_kwargs)
 
-    with get_z_encoder_for(
+    with numba_threads(n_jobs), get_z_encoder_for(
             X, d_solver.D_hat, n_atoms, n_times_atom, n_jobs,
-            solver_z, z_kwargs, reg
+            solver_z, z_kwargs, reg, sparse_z=sparse_z, dtype=dtype
     ) as z_encoder:
 
         if callable(callback):
             callback(z_encoder, [])
 
+        cost_trials = _get_cost_trials(z_encoder.n_trials, cost_sample,
+                                       random_state)
+        cost_scale = None
+        if cost_trials is not None:
+            cost_scale = z_encoder.n_trials / len(cost_trials)
+
         end_iter_func = get_iteration_func(
             eps, stopping_pobj, callback, lmbd_max,
-            name, verbose, raise_on_increase
+            name, verbose, raise_on_increase, cost_scale=cost_scale
         )
 
         # common parameters
         kwargs = dict(
             z_encoder=z_encoder, d_solver=d_solver, n_iter=n_iter,
             end_iter_func=end_iter_func, lmbd_max=lmbd_max,
-            verbose=verbose, random_state=random_state, name=name
+            verbose=verbose, random_state=random_state, name=name,
+            monitor_every=monitor_every, cost_trials=cost_trials
         )
         kwargs.update(algorithm_params)
 
@@ -213,7 +262,7 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
                 "Algorithm '{}' is not implemented to learn dictionary atoms."
                 .format(algorithm))
 
-        D_hat = d_solver.D_hat
+        D_hat = d_solver.D_hat.astype(dtype, copy=False)
         z_hat = z_encoder.get_z_hat()
 
         if sort_atoms:
@@ -236,15 +285,57 @@ def learn_d_z_multi(X, n_atoms, n_times_atom, n_iter=60, n_jobs=1,
             print("[%s] Fit in %.1fs" % (name, time.time() - start))
 
         # Rescale the solution to match the given scale of the problem
-        z_hat *= std_X
+        if sparse_z:
+            z_hat = [z_i * std_X for z_i in z_hat]
+        else:
+            z_hat *= std_X
         reg = z_encoder.reg * std_X
 
     return pobj, times, D_hat, z_hat, reg
 
 
+def _get_std(X):
+    """Standard deviation of X, computed one trial at a time.
+
+    Contrary to X.std(), no temporary array of the size of X is created, so
+    that X can be memory mapped or lazily loaded (e.g. a h5py dataset).
+    """
+    n_samples, mean, m2 = 0, 0., 0.
+    for i in range(X.shape[0]):
+        X_i = np.asarray(X[i], dtype=np.float64)
+        mean_i = X_i.mean()
+        m2_i = np.sum((X_i - mean_i) ** 2)
+
+        # merge the statistics of the trial with the previous ones
+        delta = mean_i - mean
+        n_total = n_samples + X_i.size
+        mean += delta * X_i.size / n_total
+        m2 += m2_i + delta ** 2 * n_samples * X_i.size / n_total
+        n_samples = n_total
+    return np.sqrt(m2 / n_samples)
+
+
+def _normalize_to_memmap(X, std_X, dtype):
+    """Write X / std_X in a temporary memory mapped file, one trial at a time.
+
+    The z-step workers then read their trials directly from this file. It is
+    removed once the returned array is garbage collected.
+    """
+    temp_folder = tempfile.mkdtemp(prefix='alphacsc_')
+    X_normalized = np.memmap(op.join(temp_folder, 'X.mmap'), dtype=dtype,
+                             mode='w+', shape=X.shape)
+    for i in range(X.shape[0]):
+        X_normalized[i] = np.asarray(X[i]) / std_X
+    X_normalized.flush()
+    weakref.finalize(X_normalized, shutil.rmtree, temp_folder,
+                     ignore_errors=True)
+    return X_normalized
+
+
 def _batch_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
                  lmbd_max='fixed', reg=None, verbose=0, greedy=False,
-                 random_state=None, name="batch"):
+                 random_state=None, name="batch", monitor_every=1,
+                 cost_trials=None):
 
     n_atoms = d_solver.n_atoms
 
@@ -259,7 +350,8 @@ def _batch_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
 
     # monitor cost function
     times = [0]
-    pobj = [z_encoder.get_cost()]
+    pobj = [z_encoder.get_cost(cost_trials)]
+    duration = 0
 
     for ii in range(n_iter):  # outer loop of coordinate descent
         if verbose == 1:
@@ -288,11 +380,15 @@ def _batch_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
         z_encoder.compute_z()
 
         # monitor cost function
-        times.append(time.time() - start)
-        pobj.append(z_encoder.get_cost())
+        duration += time.time() - start
+        monitored = ii % monitor_every == 0 or ii == n_iter - 1
+        if monitored:
+            times.append(duration)
+            pobj.append(z_encoder.get_cost(cost_trials))
+            duration = 0
 
         z_nnz = z_encoder.get_z_nnz()
-        if verbose > 5:
+        if verbose > 5 and monitored:
             print(
                 '[{}] Objective (z) : {:.3e} (sparsity: {:.3e})'
                 .format(name, pobj[-1], z_nnz.mean())
@@ -310,8 +406,11 @@ def _batch_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
         d_solver.update_D(z_encoder)
 
         # monitor cost function
-        times.append(time.time() - start)
-        pobj.append(z_encoder.get_cost())
+        duration += time.time() - start
+        if monitored:
+            times.append(duration)
+            pobj.append(z_encoder.get_cost(cost_trials))
+            duration = 0
 
         null_atom_indices = np.where(z_nnz == 0)[0]
         if len(null_atom_indices) > 0:
@@ -321,11 +420,11 @@ def _batch_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
             if verbose > 5:
                 print('[{}] Resampled atom {}'.format(name, k0))
 
-        if verbose > 5:
+        if verbose > 5 and monitored:
             print('[{}] Objective (d) : {:.3e}'.format(name, pobj[-1]))
 
         if ((not greedy or d_solver.D_hat.shape[0] == n_atoms)
-                and end_iter_func(z_encoder, pobj, ii)):
+                and end_iter_func(z_encoder, pobj, ii, monitored)):
             break
 
     return pobj, times
@@ -334,13 +433,14 @@ def _batch_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
 def _online_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
                   verbose=0, random_state=None, lmbd_max='fixed', reg=None,
                   alpha=.8, batch_selection='random', batch_size=1,
-                  name="online"):
+                  name="online", monitor_every=1, cost_trials=None):
 
     n_trials = z_encoder.n_trials
 
     # monitor cost function
     times = [0]
-    pobj = [z_encoder.get_cost()]
+    pobj = [z_encoder.get_cost(cost_trials)]
+    duration = 0
 
     rng = check_random_state(random_state)
     for ii in range(n_iter):  # outer loop of coordinate descent
@@ -374,11 +474,15 @@ def _online_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
         z_encoder.compute_z_partial(i0, alpha)
 
         # monitor cost function
-        times.append(time.time() - start)
-        pobj.append(z_encoder.get_cost())
+        duration += time.time() - start
+        monitored = ii % monitor_every == 0 or ii == n_iter - 1
+        if monitored:
+            times.append(duration)
+            pobj.append(z_encoder.get_cost(cost_trials))
+            duration = 0
 
         z_nnz = z_encoder.get_z_nnz()
-        if verbose > 5:
+        if verbose > 5 and monitored:
             print(
                 '[{}] Objective (z) : {:.3e} (sparsity: {:.3e})'
                 .format(name, pobj[-1], z_nnz.mean())
@@ -396,8 +500,11 @@ def _online_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
         d_solver.update_D(z_encoder)
 
         # monitor cost function
-        times.append(time.time() - start)
-        pobj.append(z_encoder.get_cost())
+        duration += time.time() - start
+        if monitored:
+            times.append(duration)
+            pobj.append(z_encoder.get_cost(cost_trials))
+            duration = 0
 
         null_atom_indices = np.where(z_nnz == 0)[0]
         if len(null_atom_indices) > 0:
@@ -406,25 +513,48 @@ def _online_learn(z_encoder, d_solver, end_iter_func, n_iter=100,
             if verbose > 5:
                 print('[{}] Resampled atom {}'.format(name, k0))
 
-        if verbose > 5:
+        if verbose > 5 and monitored:
             print('[{}] Objective (d) : {:.3e}'.format(name, pobj[-1]))
 
-        if end_iter_func(z_encoder, pobj, ii):
+        if end_iter_func(z_encoder, pobj, ii, monitored):
             break
 
     return pobj, times
 
 
+def _get_cost_trials(n_trials, cost_sample, random_state):
+    """Draw the fixed subset of trials used to evaluate the objective."""
+    if cost_sample is None or cost_sample >= n_trials:
+        return None
+    rng = check_random_state(random_state)
+    return np.sort(rng.choice(n_trials, cost_sample, replace=False))
+
+
 def get_iteration_func(eps, stopping_pobj, callback, lmbd_max, name, verbose,
-                       raise_on_increase):
-    def end_iteration(z_encoder, pobj, iteration):
+                       raise_on_increase, cost_scale=None):
+    """Return the function called at the end of each iteration.
+
+    cost_scale is None when pobj is the objective on all the trials.
+    Otherwise, pobj is the objective on a subset of the trials, that the
+    z and D updates do not necessarily decrease: the increase checks are
+    skipped, the convergence is reached when the relative changes of pobj
+    are smaller than eps in absolute value, and pobj is multiplied by
+    cost_scale to be compared to stopping_pobj.
+    """
+    def end_iteration(z_encoder, pobj, iteration, monitored=True):
         if callable(callback):
             callback(z_encoder, pobj)
 
+        # The stopping criteria are only checked when pobj has been updated.
+        if not monitored:
+            return False
+
         # Only check that the cost is always going down when the regularization
         # parameter is fixed.
         dz = (pobj[-3] - pobj[-2]) / min(pobj[-3], pobj[-2])
         du = (pobj[-2] - pobj[-1]) / min(pobj[-2], pobj[-1])
+        if cost_scale is not None:
+            dz, du = abs(dz), abs(du)
         if ((dz < eps or du < eps) and lmbd_max in ['fixed', 'scaled']):
             if dz < 0 and raise_on_increase:
                 raise RuntimeError(
@@ -441,7 +571,8 @@ def get_iteration_func(eps, stopping_pobj, callback, lmbd_max, name, verbose,
                       "= {:.3e}, {:.3e}".format(name, iteration + 1, dz, du))
                 return True
 
-        if stopping_pobj is not None and pobj[-1] < stopping_pobj:
+        full_pobj = pobj[-1] if cost_scale is None else cost_scale * pobj[-1]
+        if stopping_pobj is not None and full_pobj < stopping_pobj:
             return True
         return False
 
@@ -9,6 +9,9 @@ import numpy as np
 from .utils.convolution import numpy_convolve_uv
 from .utils.convolution import tensordot_convolve
 from .utils.convolution import _choose_convolve_multi
+from .utils.convolution import _get_convolve_method
+from .utils.convolution import _fft_transpose_convolve_d
+from .utils.dictionary import get_D_shape
 from .utils import construct_X_multi
 
 
@@ -34,7 +37,11 @@ def compute_objective(X=None, X_hat=None, z_hat=None, D=None,
     """
     obj = _l2_objective(X=X, X_hat=X_hat, D=D, constants=constants)
 
-    if reg is not None:
+    if reg is not None and isinstance(z_hat, (list, tuple)):
+        # sparse z_hat, stored as a list of (n_atoms, n_times_valid) matrices
+        z_sum = np.sum([np.ravel(z_i.sum(axis=1)) for z_i in z_hat], axis=0)
+        obj += np.sum(np.ravel(reg) * z_sum)
+    elif reg is not None:
         if isinstance(reg, (int, float)):
             obj += reg * z_hat.sum()
         else:
@@ -335,7 +342,15 @@ def _l2_gradient_zi(Xi, z_i, D=None, return_func=False):
     else:
         func = None
 
-    grad = _dense_transpose_convolve_d(Dz_i, D=D, n_channels=n_channels)
+    n_atoms, n_times_valid = z_i.shape
+    *_, n_times_atom = get_D_shape(D, n_channels)
+    method = _get_convolve_method(None, n_atoms, n_channels, n_times_valid,
+                                  n_times_atom, rank1=(D.ndim == 2),
+                                  transpose=True)
+    if method == 'fft':
+        grad = _fft_transpose_convolve_d(Dz_i, D=D, n_channels=n_channels)
+    else:
+        grad = _dense_transpose_convolve_d(Dz_i, D=D, n_channels=n_channels)
 
     return func, grad
 
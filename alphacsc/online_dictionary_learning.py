@@ -1,6 +1,7 @@
 import numpy as np
 
 from .utils.dictionary import get_lambda_max
+from .utils.parallel import numba_threads
 
 from .convolutional_dictionary_learning import DOC_FMT, DEFAULT
 from .convolutional_dictionary_learning import ConvolutionalDictionaryLearning
@@ -39,12 +40,14 @@ class OnlineCDL(ConvolutionalDictionaryLearning):
                  solver_d='auto', solver_d_kwargs={}, rank1=True, window=False,
                  uv_constraint='auto', lmbd_max='scaled', eps=1e-10,
                  D_init=None, alpha=.8, batch_size=1,
-                 batch_selection='random', verbose=10, random_state=None):
+                 batch_selection='random', verbose=10, random_state=None,
+                 dtype=np.float64, monitor_every=1, cost_sample=None):
         super().__init__(
             n_atoms, n_times_atom, reg=reg, n_iter=n_iter,
             solver_z=solver_z, solver_z_kwargs=solver_z_kwargs,
             rank1=rank1, window=window, uv_constraint=uv_constraint,
-            unbiased_z_hat=unbiased_z_hat,
+            unbiased_z_hat=unbiased_z_hat, dtype=dtype,
+            monitor_every=monitor_every, cost_sample=cost_sample,
             solver_d=solver_d, solver_d_kwargs=solver_d_kwargs,
             eps=eps, D_init=D_init,
             algorithm_params=dict(alpha=alpha, batch_size=batch_size,
@@ -61,9 +64,10 @@ class OnlineCDL(ConvolutionalDictionaryLearning):
         # X_full ( X_full / X_full.std())
         self._ensure_fit_init(X)
 
-        with get_z_encoder_for(X, self._D_hat, self.n_atoms, self.n_times_atom,
-                               self.n_jobs, self.solver_z,
-                               self.solver_z_kwargs, self.reg_) as z_encoder:
+        with numba_threads(self.n_jobs), get_z_encoder_for(
+                X, self._D_hat, self.n_atoms, self.n_times_atom, self.n_jobs,
+                self.solver_z, self.solver_z_kwargs, self.reg_,
+                dtype=self.dtype) as z_encoder:
 
             z_encoder.compute_z()
 
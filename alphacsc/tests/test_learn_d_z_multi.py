@@ -1,11 +1,14 @@
 import pytest
 import numpy as np
+from scipy import sparse
+from sklearn.exceptions import NotFittedError
 
 from alphacsc.utils import check_random_state
-from alphacsc.learn_d_z_multi import learn_d_z_multi
+from alphacsc.learn_d_z_multi import learn_d_z_multi, _get_std
 from alphacsc.convolutional_dictionary_learning import BatchCDL, GreedyCDL
 from alphacsc.online_dictionary_learning import OnlineCDL
 from alphacsc.init_dict import init_dictionary
+from alphacsc.loss_and_gradient import compute_X_and_objective_multi
 
 from alphacsc.tests.conftest import parametrize_solver_and_constraint
 
@@ -207,3 +210,177 @@ def test_learn_d_z_multi_solver_z(rank1, n_iter):
     assert np.allclose(d_hat_d, d_hat_g, rtol=1e-9, atol=1e-9)
     assert np.allclose(z_hat_d, z_hat_g, rtol=1e-9, atol=1e-9)
     assert np.allclose(pobj_d, pobj_g, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('klass', [BatchCDL, GreedyCDL])
+@pytest.mark.parametrize('rank1', [False, True])
+def test_sparse_z(X, klass, rank1):
+    kwargs = dict(n_atoms=N_ATOMS, n_times_atom=N_TIMES_ATOM, n_iter=5,
+                  rank1=rank1, sort_atoms=True, unbiased_z_hat=True,
+                  random_state=0, verbose=0)
+    cdl = klass(**kwargs)
+    z_hat = cdl.fit_transform(X)
+
+    cdl_sparse = klass(sparse_z=True, **kwargs)
+    z_hat_sparse = cdl_sparse.fit_transform(X)
+    assert isinstance(z_hat_sparse, list)
+    assert np.allclose(np.array([z.toarray() for z in z_hat_sparse]), z_hat)
+    assert np.allclose(cdl_sparse.pobj_, cdl.pobj_)
+
+    z_hat_sparse = cdl_sparse.transform(X)
+    assert np.allclose(np.array([z.toarray() for z in z_hat_sparse]),
+                       cdl.transform(X))
+    assert np.allclose(cdl_sparse.transform_inverse(z_hat_sparse),
+                       cdl.transform_inverse(cdl.transform(X)))
+
+
+def test_transform_DtD_cache(X):
+    cdl = BatchCDL(N_ATOMS, N_TIMES_ATOM, n_iter=2, random_state=0,
+                   verbose=0)
+    cdl.fit(X)
+    z_hat = cdl.transform(X)
+    DtD = cdl._DtD
+    assert DtD is not None
+
+    # DtD is reused as long as the dictionary does not change
+    assert np.allclose(cdl.transform(X), z_hat)
+    assert cdl._DtD is DtD
+
+    cdl._D_hat = cdl._D_hat[::-1].copy()
+    cdl.transform(X)
+    assert cdl._DtD is not DtD
+
+
+@pytest.mark.parametrize('klass', [BatchCDL, OnlineCDL])
+@pytest.mark.parametrize('rank1', [False, True])
+def test_float32(X, klass, rank1):
+    kwargs = dict(n_atoms=N_ATOMS, n_times_atom=N_TIMES_ATOM, n_iter=5,
+                  rank1=rank1, random_state=0, verbose=0)
+    cdl = klass(**kwargs)
+    cdl.fit(X)
+
+    cdl_32 = klass(dtype=np.float32, **kwargs)
+    cdl_32.fit(X)
+    z_hat = cdl_32.transform(X)
+    assert z_hat.dtype == np.float32
+    assert cdl_32.D_hat_.dtype == np.float32
+    assert np.allclose(cdl_32.pobj_, cdl.pobj_, rtol=1e-4)
+
+
+@pytest.mark.parametrize('algorithm', ['batch', 'online'])
+@pytest.mark.parametrize('n_trials', [4])
+def test_monitor_every(X, algorithm):
+    kwargs = dict(n_iter=7, eps=-np.inf, solver_z='lgcd', random_state=0,
+                  algorithm=algorithm, verbose=0)
+    pobj, times, D_hat, z_hat, _ = learn_d_z_multi(
+        X, N_ATOMS, N_TIMES_ATOM, **kwargs)
+
+    # the objective is evaluated at the iterations 0, 3 and 6
+    pobj_3, times_3, D_hat_3, z_hat_3, _ = learn_d_z_multi(
+        X, N_ATOMS, N_TIMES_ATOM, monitor_every=3, **kwargs)
+    assert len(pobj_3) == len(times_3) == 7
+    assert np.allclose(pobj_3, np.array(pobj)[[0, 1, 2, 7, 8, 13, 14]])
+    assert np.allclose(D_hat_3, D_hat)
+    assert np.allclose(z_hat_3, z_hat)
+
+    pobj_2, *_ = learn_d_z_multi(X, N_ATOMS, N_TIMES_ATOM, cost_sample=2,
+                                 **kwargs)
+    assert len(pobj_2) == len(pobj)
+    assert np.all(np.array(pobj_2) < np.array(pobj))
+
+
+@pytest.mark.parametrize('random_state', [1, 2, 3])
+def test_cost_sample_raise_on_increase(random_state):
+    # the updates can increase the objective on the subset of the trials,
+    # which should not be reported as a failure of the solvers.
+    rng = check_random_state(random_state)
+    X = rng.randn(10, 3, 300)
+    cdl = BatchCDL(n_atoms=3, n_times_atom=20, n_iter=20, rank1=False,
+                   solver_z='l-bfgs', cost_sample=2,
+                   random_state=random_state, verbose=0)
+    cdl.fit(X)
+    assert np.all(np.isfinite(cdl.pobj_))
+
+    # stopping_pobj is compared to the objective rescaled to all the trials,
+    # not to the much smaller objective of the subset.
+    kwargs = dict(n_iter=5, rank1=False, random_state=random_state,
+                  verbose=0)
+    pobj, *_ = learn_d_z_multi(X, 3, 20, **kwargs)
+    pobj_2, *_ = learn_d_z_multi(X, 3, 20, cost_sample=2,
+                                 stopping_pobj=pobj[0] / 2, **kwargs)
+    assert pobj_2[-1] < pobj[0] / 2
+    assert len(pobj_2) > 3
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_memmap(X, tmp_path, n_jobs):
+    filename = str(tmp_path / 'X.npy')
+    np.save(filename, X)
+    X_mmap = np.load(filename, mmap_mode='r')
+    assert np.isclose(_get_std(X_mmap), X.std())
+
+    kwargs = dict(n_iter=3, solver_z='lgcd', random_state=0, D_init='chunk',
+                  n_jobs=n_jobs, verbose=0)
+    pobj, _, D_hat, z_hat, reg = learn_d_z_multi(
+        X, N_ATOMS, N_TIMES_ATOM, **kwargs)
+    pobj_mmap, _, D_hat_mmap, z_hat_mmap, reg_mmap = learn_d_z_multi(
+        X_mmap, N_ATOMS, N_TIMES_ATOM, **kwargs)
+    assert np.allclose(pobj_mmap, pobj)
+    assert np.allclose(D_hat_mmap, D_hat)
+    assert np.allclose(z_hat_mmap, z_hat)
+    assert np.isclose(reg_mmap, reg)
+
+
+@pytest.mark.parametrize('rank1', [True, False])
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_transform_chunks(rank1, n_jobs, tmp_path):
+    rng = check_random_state(42)
+    X = rng.randn(1, N_CHANNELS, 2000)
+
+    cdl = BatchCDL(N_ATOMS, N_TIMES_ATOM, n_iter=3, solver_z='lgcd',
+                   rank1=rank1, random_state=0, n_jobs=n_jobs, verbose=0)
+    cdl.fit(X)
+    z_hat = cdl.transform(X)
+
+    chunks = list(cdl.transform_chunks(X, chunk_size=300))
+    assert len(chunks) == 6
+    assert all(sparse.issparse(z_chunk) for z_chunk in chunks)
+    assert all(z_chunk.shape[1] == 300 for z_chunk in chunks[:-1])
+    z_chunks = sparse.hstack(chunks).toarray()[None]
+    assert z_chunks.shape == z_hat.shape
+
+    pobj = compute_X_and_objective_multi(X, z_hat, cdl._D_hat, reg=cdl.reg_,
+                                         feasible_evaluation=False)
+    pobj_chunks = compute_X_and_objective_multi(
+        X, z_chunks, cdl._D_hat, reg=cdl.reg_, feasible_evaluation=False)
+    assert np.isclose(pobj_chunks, pobj, rtol=1e-3)
+
+    # the signal can be memory mapped and given with its trial dimension
+    filename = str(tmp_path / 'X.npy')
+    np.save(filename, X)
+    X_mmap = np.load(filename, mmap_mode='r')
+    chunks_mmap = list(cdl.transform_chunks(X_mmap, chunk_size=300))
+    assert np.allclose(sparse.hstack(chunks_mmap).toarray(), z_chunks[0])
+    chunks_2d = list(cdl.transform_chunks(X[0], chunk_size=300))
+    assert np.allclose(sparse.hstack(chunks_2d).toarray(), z_chunks[0])
+
+    # a signal shorter than two chunks is encoded in a single chunk
+    chunks = list(cdl.transform_chunks(X[..., :500], chunk_size=300))
+    assert len(chunks) == 1
+    assert chunks[0].shape == (N_ATOMS, 500 - N_TIMES_ATOM + 1)
+
+
+def test_transform_chunks_errors(X):
+    cdl = BatchCDL(N_ATOMS, N_TIMES_ATOM, n_iter=1, random_state=0,
+                   verbose=0)
+    with pytest.raises(NotFittedError):
+        next(cdl.transform_chunks(X[:1], chunk_size=300))
+
+    cdl.fit(X)
+    with pytest.raises(ValueError, match="single signal"):
+        next(cdl.transform_chunks(X, chunk_size=300))
+    with pytest.raises(ValueError, match="overlap"):
+        next(cdl.transform_chunks(X[:1], chunk_size=300,
+                                  overlap=N_TIMES_ATOM - 1))
+    with pytest.raises(ValueError, match="chunk_size"):
+        next(cdl.transform_chunks(X[:1], chunk_size=3 * N_TIMES_ATOM - 2))
@@ -0,0 +1,93 @@
+import pytest
+import numpy as np
+
+from alphacsc import BatchCDL
+from alphacsc._stream_encoder import StreamEncoder
+from alphacsc.update_z_multi import update_z_multi
+from alphacsc.utils.dictionary import get_lambda_max
+from alphacsc.loss_and_gradient import compute_X_and_objective_multi
+
+from conftest import N_ATOMS, N_CHANNELS, N_TIMES_ATOM
+
+
+def _stream(encoder, X, n_samples):
+    z_final = [encoder.push(X[:, t:t + n_samples])
+               for t in range(0, X.shape[1], n_samples)]
+    z_final.append(encoder.flush())
+    return np.concatenate(z_final, axis=1)
+
+
+@pytest.mark.parametrize('n_trials', [1])
+@pytest.mark.parametrize('rank1', [True, False])
+@pytest.mark.parametrize('n_samples', [1, 7, 50])
+def test_stream_encoder(X, D_hat, n_samples):
+    reg = .1 * get_lambda_max(X, D_hat).max()
+    z_hat, _, _ = update_z_multi(X, D_hat, reg, solver='lgcd',
+                                 solver_kwargs=dict(tol=1e-5))
+    pobj = compute_X_and_objective_multi(X, z_hat, D_hat, reg=reg,
+                                         feasible_evaluation=False)
+
+    def stream_objective(window):
+        encoder = StreamEncoder(D_hat, N_CHANNELS, reg, window=window,
+                                tol=1e-5)
+        z_stream = _stream(encoder, X[0], n_samples)
+        assert z_stream.shape == z_hat.shape[1:]
+        assert encoder.n_times_final == z_hat.shape[2]
+        assert encoder.get_latency_stats()['n_pushes'] == np.ceil(
+            X.shape[2] / n_samples)
+        return compute_X_and_objective_multi(
+            X, z_stream[None], D_hat, reg=reg, feasible_evaluation=False)
+
+    # without finalising the codes before the end, the stream converges to
+    # the codes of the full signal
+    assert np.isclose(stream_objective(window=X.shape[2]), pobj, rtol=1e-4)
+
+    # finalising the codes older than a few atom lengths is close
+    assert np.isclose(stream_objective(window=3), pobj, rtol=1e-3)
+
+
+@pytest.mark.parametrize('rank1', [True, False])
+def test_stream_encoder_finalise(D_hat, rng):
+    encoder = StreamEncoder(D_hat, N_CHANNELS, reg=.1, window=2)
+    assert np.isnan(encoder.get_latency_stats()['mean'])
+
+    # no valid time before n_times_atom samples
+    z_final = encoder.push(rng.randn(N_CHANNELS, N_TIMES_ATOM - 1))
+    assert z_final.shape == (N_ATOMS, 0)
+
+    # the codes are finalised once they leave the window
+    z_final = encoder.push(rng.randn(N_CHANNELS, 2 * N_TIMES_ATOM + 5))
+    assert z_final.shape == (N_ATOMS, 5)
+    assert encoder.flush().shape == (N_ATOMS, 2 * N_TIMES_ATOM)
+    assert encoder.n_times_final == 2 * N_TIMES_ATOM + 5
+
+    stats = encoder.get_latency_stats()
+    assert stats['n_pushes'] == 2
+    assert 0 < stats['median'] <= stats['max']
+
+    encoder.reset()
+    assert encoder.n_times_final == 0
+    assert encoder.get_latency_stats()['n_pushes'] == 0
+
+    with pytest.raises(ValueError, match="n_channels"):
+        encoder.push(rng.randn(N_CHANNELS + 1, 10))
+    with pytest.raises(ValueError, match="window"):
+        StreamEncoder(D_hat, N_CHANNELS, reg=.1, window=0)
+
+
+def test_get_stream_encoder(rng):
+    X = rng.randn(2, N_CHANNELS, 500)
+    cdl = BatchCDL(N_ATOMS, N_TIMES_ATOM, n_iter=3, solver_z='lgcd',
+                   random_state=0, verbose=0)
+    cdl.fit(X)
+    z_hat = cdl.transform(X[:1])
+
+    encoder = cdl.get_stream_encoder(window=4)
+    assert np.array_equal(encoder.DtD, cdl._get_DtD())
+    z_stream = _stream(encoder, X[0], 10)
+    pobj = compute_X_and_objective_multi(
+        X[:1], z_hat, cdl._D_hat, reg=cdl.reg_, feasible_evaluation=False)
+    pobj_stream = compute_X_and_objective_multi(
+        X[:1], z_stream[None], cdl._D_hat, reg=cdl.reg_,
+        feasible_evaluation=False)
+    assert np.isclose(pobj_stream, pobj, rtol=1e-3)
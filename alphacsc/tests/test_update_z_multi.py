@@ -137,3 +137,91 @@ def test_n_jobs_larger_than_n_trials():
     uv = rng.randn(n_atoms, n_channels + n_times_atom)
 
     z_hat, ztz, ztX = update_z_multi(X, uv, 0.1, n_jobs=3)
+
+
+@pytest.mark.parametrize('strategy', ['greedy', 'cyclic'])
+@pytest.mark.parametrize('freeze_support', [False, True])
+@pytest.mark.parametrize('rank1', [True, False])
+def test_cd_numba(strategy, freeze_support, rank1):
+    n_trials, n_channels, n_times = 2, 3, 100
+    n_times_atom, n_atoms = 10, 4
+    n_times_valid = n_times - n_times_atom + 1
+    reg = 0.1
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(n_trials, n_channels, n_times)
+    if rank1:
+        D = rng.randn(n_atoms, n_channels + n_times_atom)
+    else:
+        D = rng.randn(n_atoms, n_channels, n_times_atom)
+    z0 = abs(rng.randn(n_trials, n_atoms, n_times_valid))
+    z0[z0 < 1] = 0
+
+    solver_kwargs = dict(strategy=strategy, max_iter=100)
+    z_hat, _, _ = update_z_multi(X, D, reg, z0=z0, solver='lgcd',
+                                 solver_kwargs=solver_kwargs,
+                                 freeze_support=freeze_support)
+    solver_kwargs['use_numba'] = True
+    z_hat_numba, _, _ = update_z_multi(X, D, reg, z0=z0, solver='lgcd',
+                                       solver_kwargs=solver_kwargs,
+                                       freeze_support=freeze_support)
+    assert np.array_equal(z_hat, z_hat_numba)
+
+
+@pytest.mark.parametrize('use_numba', [False, True])
+@pytest.mark.parametrize('freeze_support', [False, True])
+def test_incremental_ztz(use_numba, freeze_support):
+    n_trials, n_channels, n_times = 2, 3, 100
+    n_times_atom, n_atoms = 10, 4
+    n_times_valid = n_times - n_times_atom + 1
+    reg = 0.1
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(n_trials, n_channels, n_times)
+    D = rng.randn(n_atoms, n_channels + n_times_atom)
+    z0 = abs(rng.randn(n_trials, n_atoms, n_times_valid))
+    z0[z0 < 1] = 0
+    ztz0 = compute_ztz(z0, n_times_atom)
+    ztX0 = compute_ztX(z0, X)
+
+    solver_kwargs = dict(max_iter=100, use_numba=use_numba)
+    z_hat, ztz, ztX = update_z_multi(X, D, reg, z0=z0, solver='lgcd',
+                                     solver_kwargs=solver_kwargs,
+                                     freeze_support=freeze_support,
+                                     return_ztz=True, ztz=ztz0, ztX=ztX0)
+    assert np.allclose(ztz, compute_ztz(z_hat, n_times_atom))
+    assert np.allclose(ztX, compute_ztX(z_hat, X))
+
+    # the statistics of z0 are not modified inplace
+    assert np.allclose(ztz0, compute_ztz(z0, n_times_atom))
+
+
+@pytest.mark.parametrize('solver, solver_kwargs', [
+    ('l-bfgs', dict()), ('fista', dict()),
+    ('lgcd', dict()), ('lgcd', dict(use_numba=True))])
+def test_update_z_multi_float32(solver, solver_kwargs):
+    n_trials, n_channels, n_times = 2, 3, 100
+    n_times_atom, n_atoms = 10, 4
+    reg = 0.1
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(n_trials, n_channels, n_times)
+    D = rng.randn(n_atoms, n_channels + n_times_atom)
+
+    z_hat, ztz, ztX = update_z_multi(X, D, reg, solver=solver,
+                                     solver_kwargs=solver_kwargs,
+                                     return_ztz=True)
+    z_hat_32, ztz_32, ztX_32 = update_z_multi(X, D, reg, solver=solver,
+                                              solver_kwargs=solver_kwargs,
+                                              return_ztz=True,
+                                              dtype=np.float32)
+    assert z_hat_32.dtype == np.float32
+    assert ztz_32.dtype == ztX_32.dtype == np.float64
+    # the minimizer is not unique, compare the objectives instead of z_hat
+    obj = compute_X_and_objective_multi(X, z_hat, D_hat=D, reg=reg,
+                                        feasible_evaluation=False)
+    obj_32 = compute_X_and_objective_multi(X, z_hat_32, D_hat=D, reg=reg,
+                                           feasible_evaluation=False)
+    assert np.isclose(obj_32, obj, rtol=1e-4)
+    assert np.allclose(ztz_32, compute_ztz(z_hat_32, n_times_atom))
+    assert np.allclose(ztX_32, compute_ztX(z_hat_32, X.astype(np.float32)))
@@ -179,6 +179,32 @@ def test_get_cost(solver, X, D_hat, requires_dicodile):
         assert np.isclose(cost, final_cost)
 
 
+@pytest.mark.parametrize('n_trials', [3])
+@pytest.mark.parametrize('rank1', [True, False])
+def test_get_cost_statistics(X, D_hat, rng):
+    """Test that the cost computed from ztz, ztX and XtX is the one of the
+    reconstructed signal, and that it is not used once they are stale."""
+
+    def reconstruction_cost(z_encoder):
+        X_hat = construct_X_multi(z_encoder.z_hat, z_encoder.D_hat,
+                                  n_channels=N_CHANNELS)
+        return compute_objective(X=X, X_hat=X_hat, z_hat=z_encoder.z_hat,
+                                 reg=0.1)
+
+    with get_z_encoder_for(solver='lgcd', X=X, D_hat=D_hat, n_atoms=N_ATOMS,
+                           n_times_atom=N_TIMES_ATOM, n_jobs=1) as z_encoder:
+        z_encoder.compute_z()
+        assert np.isclose(z_encoder.get_cost(), reconstruction_cost(z_encoder))
+
+        # the statistics do not depend on D
+        z_encoder.set_D(D_hat + 0.1 * rng.randn(*D_hat.shape))
+        assert np.isclose(z_encoder.get_cost(), reconstruction_cost(z_encoder))
+
+        # the statistics are averaged over the batches in compute_z_partial
+        z_encoder.compute_z_partial(slice(0, 1))
+        assert np.isclose(z_encoder.get_cost(), reconstruction_cost(z_encoder))
+
+
 @pytest.mark.parametrize('solver, n_trials, rank1', [('lgcd', 2, True),
                                                      ('l-bfgs', 5, False),
                                                      ('dicodile', 1, False)])
@@ -285,3 +311,93 @@ def test_get_sufficient_statistics_partial_error(X, D_hat):
     with pytest.raises(AssertionError,
                        match="compute_z_partial should be called.*"):
         z_encoder.get_sufficient_statistics_partial()
+
+
+@pytest.mark.parametrize('solver, n_trials, rank1', [('lgcd', 2, True),
+                                                     ('l-bfgs', 3, False)])
+def test_sparse_z(solver, X, D_hat):
+    """Test that sparse_z gives the same codes and statistics."""
+
+    kwargs = dict(solver=solver, X=X, D_hat=D_hat, n_atoms=N_ATOMS,
+                  n_times_atom=N_TIMES_ATOM, n_jobs=2)
+    with get_z_encoder_for(**kwargs) as z_encoder:
+        z_encoder.compute_z()
+        z_hat = z_encoder.get_z_hat()
+        ztz, ztX = z_encoder.get_sufficient_statistics()
+        cost = z_encoder.get_cost()
+        z_nnz = z_encoder.get_z_nnz()
+
+    with get_z_encoder_for(sparse_z=True, **kwargs) as z_encoder:
+        z_encoder.compute_z()
+        z_hat_sparse = z_encoder.get_z_hat()
+        ztz_sparse, ztX_sparse = z_encoder.get_sufficient_statistics()
+
+        assert isinstance(z_hat_sparse, list)
+        assert np.allclose(np.array([z.toarray() for z in z_hat_sparse]),
+                           z_hat)
+        assert np.allclose(ztz_sparse, ztz)
+        assert np.allclose(ztX_sparse, ztX)
+        assert np.isclose(z_encoder.get_cost(), cost)
+        assert np.allclose(z_encoder.get_z_nnz(), z_nnz)
+
+
+@pytest.mark.parametrize('solver, n_trials, rank1', [('lgcd', 3, True)])
+def test_persistent_pool(solver, X, D_hat):
+    """Test that the pool and the memory mapped X are kept across calls."""
+
+    z_encoder = get_z_encoder_for(solver=solver, X=X, D_hat=D_hat,
+                                  n_atoms=N_ATOMS, n_times_atom=N_TIMES_ATOM,
+                                  n_jobs=2)
+    z_encoder.compute_z()
+    z_hat = z_encoder.get_z_hat().copy()
+
+    with z_encoder:
+        parallel = z_encoder._parallel
+        assert isinstance(z_encoder.X, np.memmap)
+        assert np.array_equal(z_encoder.X, X)
+
+        z_encoder.z_hat[:] = 0
+        z_encoder.compute_z()
+        assert np.allclose(z_hat, z_encoder.get_z_hat())
+
+        z_encoder.compute_z()
+        assert z_encoder._parallel is parallel
+
+    assert z_encoder._parallel is None
+    assert z_encoder.X is X
+
+
+@pytest.mark.parametrize('solver, n_trials, rank1', [('lgcd', 2, True),
+                                                     ('lgcd', 2, False)])
+def test_DtD_cache(solver, X, D_hat):
+    """Test that DtD is computed once per dictionary."""
+    from alphacsc.utils.compute_constants import compute_DtD
+
+    z_encoder = get_z_encoder_for(solver=solver, X=X, D_hat=D_hat,
+                                  n_atoms=N_ATOMS, n_times_atom=N_TIMES_ATOM,
+                                  n_jobs=1)
+    assert np.allclose(z_encoder.DtD,
+                       compute_DtD(D_hat, n_channels=N_CHANNELS))
+
+    D_hat = 2 * D_hat
+    z_encoder.set_D(D_hat)
+    assert np.allclose(z_encoder.DtD,
+                       compute_DtD(D_hat, n_channels=N_CHANNELS))
+
+
+@pytest.mark.parametrize('solver, n_trials, rank1', [('lgcd', 2, True)])
+def test_incremental_ztz(solver, X, D_hat):
+    """Test that the statistics updated during the coordinate descent match
+    the ones of the codes across calls to compute_z."""
+
+    z_encoder = get_z_encoder_for(solver=solver, X=X, D_hat=D_hat,
+                                  n_atoms=N_ATOMS, n_times_atom=N_TIMES_ATOM,
+                                  n_jobs=1,
+                                  solver_kwargs=dict(incremental_ztz=True))
+    for _ in range(3):
+        z_encoder.compute_z()
+        ztz, ztX = z_encoder.get_sufficient_statistics()
+        z_hat = z_encoder.get_z_hat()
+        assert np.allclose(ztz, compute_ztz(z_hat, N_TIMES_ATOM))
+        assert np.allclose(ztX, compute_ztX(z_hat, X))
+        z_encoder.set_D(0.9 * z_encoder.D_hat)
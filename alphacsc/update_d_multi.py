@@ -5,7 +5,7 @@
 #          Thomas Moreau <thomas.moreau@inria.fr>
 import numpy as np
 
-from .utils.compute_constants import compute_ztz, compute_ztX
+from .utils.compute_constants import compute_ztz, compute_ztX, _get_z_shape
 
 
 def squeeze_all_except_one(X, axis=0):
@@ -48,7 +48,7 @@ def prox_d(D, return_norm=False):
 
 
 def _get_d_update_constants(X, z):
-    n_trials, n_atoms, n_times_valid = z.shape
+    n_trials, n_atoms, n_times_valid = _get_z_shape(z)
     n_trials, n_channels, n_times = X.shape
     n_times_atom = n_times - n_times_valid + 1
 
@@ -6,22 +6,26 @@
 import time
 
 import numpy as np
-from scipy import optimize
+from scipy import optimize, sparse
 from joblib import Parallel, delayed
 
 
 from .utils.optim import fista
 from .utils import check_random_state
-from .utils.dictionary import get_D_shape
+from .utils.dictionary import get_D, get_D_shape
 from .loss_and_gradient import gradient_zi
 from .utils.coordinate_descent import _coordinate_descent_idx
+from .utils.screening import compute_DtX, gap_safe_screening
+from .utils.parallel import numba_threads
 from .utils.compute_constants import compute_DtD, compute_ztz, compute_ztX
 
 
 def update_z_multi(X, D, reg, z0=None, solver='l-bfgs', solver_kwargs=dict(),
                    freeze_support=False,
                    return_ztz=False, timing=False, n_jobs=1,
-                   random_state=None, debug=False):
+                   random_state=None, debug=False, sparse_z=False,
+                   parallel=None, DtD=None, ztz=None, ztX=None,
+                   dtype=np.float64, return_stats=False):
     """Update z using L-BFGS with positivity constraints
 
     Parameters
@@ -35,11 +39,18 @@ def update_z_multi(X, D, reg, z0=None, solver='l-bfgs', solver_kwargs=dict(),
     reg : float
         The regularization constant
     z0 : None | array, shape (n_trials, n_atoms, n_times_valid)
-        Init for z (can be used for warm restart).
+        Init for z (can be used for warm restart). Can also be a list of
+        n_trials sparse matrices of shape (n_atoms, n_times_valid).
     solver : 'l-bfgs' | "lgcd"
         The solver to use.
     solver_kwargs : dict
-        Parameters for the solver
+        Parameters for the solver. For solver='lgcd', setting
+        ``use_numba=True`` runs the coordinate descent in a compiled kernel.
+        For solver='lgcd', 'ista' and 'fista', setting ``screening=True``
+        discards the coordinates that are provably zero at the optimum with
+        the gap safe screening rule, before the solve and every
+        ``screen_every`` iterations (passes over the segments for 'lgcd',
+        default 10).
     freeze_support : boolean
         If True, the support of z0 is frozen.
     return_ztz : boolean
@@ -48,55 +59,113 @@ def update_z_multi(X, D, reg, z0=None, solver='l-bfgs', solver_kwargs=dict(),
         If True, returns the cost function value at each iteration and the
         time taken by each iteration for each signal.
     n_jobs : int
-        The number of parallel jobs.
+        The number of parallel jobs. It is also the number of threads used
+        by the numba kernels computing DtD, ztz and the D-step gradient.
     random_state : None or int or RandomState
         random_state to make randomized experiments determinist. If None, no
         random_state is given. If it is an integer, it will be used to seed a
         RandomState.
     debug : bool
         If True, check the gradients.
+    sparse_z : bool
+        If True, the codes are returned as a list of n_trials CSR matrices of
+        shape (n_atoms, n_times_valid). Each trial is only densified inside
+        the worker solving it, so the memory used to store the codes scales
+        with the number of activations.
+    parallel : joblib.Parallel | None
+        If not None, the pool of workers used to compute the codes of the
+        trials. Otherwise, a new pool with n_jobs workers is created.
+    DtD : array, shape (n_atoms, n_atoms, 2 * n_times_atom - 1) | None
+        Precomputed DtD for the solver 'lgcd'. If None, it is computed.
+    ztz, ztX : arrays | None
+        Statistics ztz and ztX of z0 (zero arrays if z0 is None). If both are
+        given with solver='lgcd' and return_ztz=True, the returned statistics
+        are maintained during the coordinate descent, with a cost
+        proportional to the number of coordinate updates, instead of being
+        recomputed from the new codes.
+    dtype : np.float64 | np.float32
+        Floating point precision of the z-step. X, D and z0 are cast to dtype
+        and the codes are returned with this dtype. The statistics ztz and ztX
+        are accumulated and returned in float64.
+    return_stats : boolean
+        If True, also returns statistics on the solver for each trial.
 
     Returns
     -------
     z : array, shape (n_trials, n_atoms, n_times - n_times_atom + 1)
-        The true codes.
+        The true codes. If sparse_z is True, list of n_trials sparse matrices
+        of shape (n_atoms, n_times - n_times_atom + 1).
+    ztz, ztX : arrays | None
+        The statistics of z if return_ztz is True.
+    stats : list of dict
+        Only returned if return_stats is True. For each trial, the statistics
+        of the solver. With screening, they contain the number of coordinates
+        'n_coordinates', the number of screened coordinates 'n_screened' and
+        the duality gap 'gap' at the last screening.
     """
     n_trials, n_channels, n_times = X.shape
     n_atoms, n_channels, n_times_atom = get_D_shape(D, n_channels)
     n_times_valid = n_times - n_times_atom + 1
 
+    X = X.astype(dtype, copy=False)
+    D = D.astype(dtype, copy=False)
+
     # Generate different seeds for the parallel updates
     rng = check_random_state(random_state)
     parallel_seeds = [rng.randint(2**31 - 1) for _ in range(n_trials)]
 
     if z0 is None:
-        z0 = np.zeros((n_trials, n_atoms, n_times_valid))
+        z0 = [None] * n_trials
+
+    # DtD does not depend on the trial, compute it once for all the workers
+    if solver in ["lgcd", "dicodile"] and DtD is None:
+        with numba_threads(n_jobs):
+            DtD = compute_DtD(D=D, n_channels=n_channels)
 
     # now estimate the codes
     delayed_update_z = delayed(_update_z_multi_idx)
 
-    results = Parallel(n_jobs=n_jobs)(
+    if parallel is None:
+        parallel = Parallel(n_jobs=n_jobs)
+
+    incremental_ztz = (return_ztz and solver == 'lgcd' and ztz is not None
+                       and ztX is not None)
+
+    results = parallel(
         delayed_update_z(X[i], D, reg, z0[i], debug, solver, solver_kwargs,
-                         freeze_support, return_ztz=return_ztz,
-                         timing=timing, random_state=seed)
+                         freeze_support, return_ztz=False,
+                         timing=timing, random_state=seed,
+                         sparse_z=sparse_z, DtD=DtD,
+                         incremental_ztz=incremental_ztz, dtype=dtype)
         for i, seed in enumerate(parallel_seeds))
 
     # Post process the results to get separate objects
-    z_hats, pobj, times = [], [], []
-    if return_ztz:
-        ztz = np.zeros((n_atoms, n_atoms, 2 * n_times_atom - 1))
-        ztX = np.zeros((n_atoms, n_channels, n_times_atom))
-    else:
-        ztz, ztX = None, None
-    for z_hat, ztz_i, ztX_i, pobj_i, times_i in results:
+    z_hats, pobj, times, stats = [], [], [], []
+    if incremental_ztz:
+        ztz, ztX = ztz.copy(), ztX.copy()
+    for z_hat, ztz_i, ztX_i, pobj_i, times_i, stats_i in results:
         z_hats.append(z_hat), pobj.append(pobj_i), times.append(times_i)
-        if return_ztz:
+        stats.append(stats_i)
+        if incremental_ztz:
             ztz += ztz_i
             ztX += ztX_i
 
-    # stack and reorder the columns
-    z_hats = np.array(z_hats).reshape(n_trials, n_atoms, n_times_valid)
+    if not sparse_z:
+        # stack and reorder the columns
+        z_hats = np.array(z_hats).reshape(n_trials, n_atoms, n_times_valid)
+
+    # The statistics are computed on all the trials at once, which lets
+    # compute_ztz and compute_ztX pick the fastest algorithm for the overall
+    # sparsity of the codes and parallelize over the trials.
+    if not return_ztz:
+        ztz, ztX = None, None
+    elif not incremental_ztz:
+        with numba_threads(n_jobs):
+            ztz = compute_ztz(z_hats, n_times_atom)
+            ztX = compute_ztX(z_hats, X)
 
+    if return_stats:
+        return z_hats, ztz, ztX, stats
     return z_hats, ztz, ztX
 
 
@@ -120,7 +189,17 @@ class BoundGenerator(object):
 
 def _update_z_multi_idx(X_i, D, reg, z0_i, debug, solver='l-bfgs',
                         solver_kwargs=dict(), freeze_support=False,
-                        return_ztz=False, timing=False, random_state=None):
+                        return_ztz=False, timing=False, random_state=None,
+                        sparse_z=False, DtD=None, incremental_ztz=False,
+                        dtype=np.float64):
+    """Update the codes of one trial.
+
+    If incremental_ztz is True, the solver should be 'lgcd' and the returned
+    ztz and ztX are the variations of the statistics between z0_i and z_hat,
+    maintained during the coordinate descent. Otherwise, if return_ztz is
+    True, they are the statistics of z_hat. The last output is a dict with
+    statistics on the solver.
+    """
     t_start = time.time()
     n_channels, n_times = X_i.shape
     n_atoms, n_channels, n_times_atom = get_D_shape(D, n_channels)
@@ -128,11 +207,18 @@ def _update_z_multi_idx(X_i, D, reg, z0_i, debug, solver='l-bfgs',
 
     assert not (freeze_support and z0_i is None), 'Impossible !'
 
+    if sparse.issparse(z0_i):
+        z0_i = z0_i.toarray()
+    if z0_i is not None:
+        z0_i = z0_i.astype(dtype, copy=False)
+
     rng = check_random_state(random_state)
 
     constants = {}
     if solver in ["lgcd", "dicodile"]:
-        constants['DtD'] = compute_DtD(D=D, n_channels=n_channels)
+        if DtD is None:
+            DtD = compute_DtD(D=D, n_channels=n_channels)
+        constants['DtD'] = DtD
     init_timing = time.time() - t_start
 
     def func_and_grad(zi):
@@ -140,9 +226,10 @@ def _update_z_multi_idx(X_i, D, reg, z0_i, debug, solver='l-bfgs',
                            reg=reg, return_func=True, flatten=True)
 
     if z0_i is None:
-        z0_i = np.zeros(n_atoms, n_times_valid)
+        z0_i = np.zeros((n_atoms, n_times_valid), dtype=dtype)
 
     times, pobj = None, None
+    stats = {}
     if timing:
         times = [init_timing]
         pobj = [func_and_grad(z0_i)[0]]
@@ -176,15 +263,52 @@ def _update_z_multi_idx(X_i, D, reg, z0_i, debug, solver='l-bfgs',
         )
         fista_kwargs.update(solver_kwargs)
 
+        screening = fista_kwargs.pop('screening', False)
+        screen_every = fista_kwargs.pop('screen_every', 10)
+        screening = screening and np.all(np.asarray(reg) > 0)
+
         def objective(z_hat):
             return func_and_grad(z_hat)[0]
 
+        # support is 0 for the coordinates frozen to zero, either outside the
+        # support of z0 or screened.
+        support = np.ones(n_atoms * n_times_valid, dtype=bool)
+        if freeze_support:
+            support = z0_i.ravel() != 0
+        if screening:
+            DtX = compute_DtX(X_i, D)
+            XtX = np.dot(X_i.ravel(), X_i.ravel().astype(np.float64))
+            D_full = D if D.ndim == 3 else get_D(D, n_channels)
+            norm_Dk = np.sum(D_full ** 2, axis=(1, 2))[:, None]
+            n_grad = [0]
+
+        def screen(z_hat, grad):
+            z_hat = z_hat.reshape(n_atoms, n_times_valid)
+            grad = grad.reshape(n_atoms, n_times_valid) - reg
+            screened, stats['gap'] = gap_safe_screening(
+                z_hat, grad, DtX, XtX, reg, norm_Dk)
+            support[screened.ravel()] = False
+            stats['n_screened'] = int(n_atoms * n_times_valid
+                                      - support.sum())
+
         def grad(z_hat):
-            return func_and_grad(z_hat)[1]
+            grad = func_and_grad(z_hat)[1]
+            # The gap is only defined for feasible points, the extrapolated
+            # points of the momentum can be negative.
+            if screening and n_grad[0] % screen_every == 0 and np.all(
+                    z_hat >= 0):
+                screen(z_hat, grad)
+            if screening:
+                n_grad[0] += 1
+            return grad
 
         def prox(z_hat, step_size=0):
-            return np.maximum(z_hat - step_size * reg, 0.)
+            return np.maximum(z_hat - step_size * reg, 0.) * support
         z0_i = z0_i.ravel()
+        if screening:
+            stats['n_coordinates'] = n_atoms * n_times_valid
+            screen(z0_i, func_and_grad(z0_i)[1])
+            z0_i = z0_i * support
         output = fista(objective, grad, prox, step_size=None, x0=z0_i,
                        adaptive_step_size=True, timing=timing,
                        name="Update z", **fista_kwargs)
@@ -201,10 +325,19 @@ def _update_z_multi_idx(X_i, D, reg, z0_i, debug, solver='l-bfgs',
         n_seg = solver_kwargs.get('n_seg', 'auto')
         max_iter = solver_kwargs.get('max_iter', 1e15)
         strategy = solver_kwargs.get('strategy', 'greedy')
+        use_numba = solver_kwargs.get('use_numba', False)
+        screening = solver_kwargs.get('screening', False)
+        screen_every = solver_kwargs.get('screen_every', 10)
+        ztz, ztX = None, None
+        if incremental_ztz:
+            ztz = np.zeros((n_atoms, n_atoms, 2 * n_times_atom - 1))
+            ztX = np.zeros((n_atoms, n_channels, n_times_atom))
         output = _coordinate_descent_idx(
             X_i, D, constants, reg=reg, z0=z0_i, max_iter=max_iter, tol=tol,
             strategy=strategy, n_seg=n_seg, freeze_support=freeze_support,
-            timing=timing, random_state=rng, name="Update z")
+            timing=timing, use_numba=use_numba, random_state=rng,
+            name="Update z", ztz=ztz, ztX=ztX, screening=screening,
+            screen_every=screen_every, stats=stats)
 
         if timing:
             z_hat, pobj, times = output
@@ -215,12 +348,19 @@ def _update_z_multi_idx(X_i, D, reg, z0_i, debug, solver='l-bfgs',
         raise ValueError("Unrecognized solver %s. Must be 'ista', 'fista',"
                          " 'l-bfgs', or 'lgcd'." % solver)
 
-    z_hat = z_hat.reshape(n_atoms, n_times_valid)
+    # l-bfgs always works in float64
+    z_hat = z_hat.reshape(n_atoms, n_times_valid).astype(dtype, copy=False)
 
-    if return_ztz:
+    if incremental_ztz:
+        assert solver in ["lgcd", "dicodile"], (
+            "incremental_ztz is only available with solver='lgcd'.")
+    elif return_ztz:
         ztz = compute_ztz(z_hat[None], n_times_atom)
         ztX = compute_ztX(z_hat[None], X_i[None])
     else:
         ztz, ztX = None, None
 
-    return z_hat, ztz, ztX, pobj, times
+    if sparse_z:
+        z_hat = sparse.csr_matrix(z_hat)
+
+    return z_hat, ztz, ztX, pobj, times, stats
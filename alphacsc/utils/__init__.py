@@ -4,6 +4,7 @@ from .convolution import construct_X, construct_X_multi, _choose_convolve
 from .validation import check_random_state, check_consistent_shape
 from .validation import check_dimension
 from .profile_this import profile_this
+from .parallel import numba_threads, set_numba_parallel
 from .signal import split_signal
 from .signal import check_univariate_signal
 from .signal import check_multivariate_signal
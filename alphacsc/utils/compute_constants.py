@@ -1,98 +1,399 @@
 import numba
 import numpy as np
+from scipy import fft, sparse
+
+from .parallel import get_numba_n_threads
 
 
 def compute_DtD(D, n_channels=None):
     """Compute the DtD matrix
+
+    The atom pairs are split between the numba threads, see
+    alphacsc.utils.parallel.numba_threads.
     """
+    parallel = get_numba_n_threads() > 1
     if D.ndim == 2:
+        if parallel:
+            return _compute_DtD_uv_parallel(D, n_channels)
         return _compute_DtD_uv(D, n_channels)
 
+    if parallel:
+        return _compute_DtD_D_parallel(D)
     return _compute_DtD_D(D)
 
 
-@numba.jit((numba.float64[:, :], numba.int64), nopython=True, cache=True)
+@numba.jit(nopython=True, cache=True)
+def _add_DtD_uv_row(DtD, uv, n_channels, k0):  # pragma: no cover
+    n_atoms = uv.shape[0]
+    n_times_atom = uv.shape[1] - n_channels
+    t0 = n_times_atom - 1
+    for k in range(n_atoms):
+        for t in range(n_times_atom):
+            if t == 0:
+                DtD[k0, k, t0] = np.dot(uv[k0, n_channels:],
+                                        uv[k, n_channels:])
+            else:
+                DtD[k0, k, t0 + t] = np.dot(uv[k0, n_channels:-t],
+                                            uv[k, n_channels + t:])
+                DtD[k0, k, t0 - t] = np.dot(uv[k0, n_channels + t:],
+                                            uv[k, n_channels:-t])
+        DtD[k0, k] *= np.dot(uv[k0, :n_channels], uv[k, :n_channels])
+
+
+@numba.jit([(numba.float64[:, :], numba.int64),
+            (numba.float32[:, :], numba.int64)], nopython=True, cache=True)
 def _compute_DtD_uv(uv, n_channels):  # pragma: no cover
     # TODO: benchmark the cross correlate function of numpy
     n_atoms, n_times_atom = uv.shape
     n_times_atom -= n_channels
 
-    u = uv[:, :n_channels]
-
     DtD = np.zeros(shape=(n_atoms, n_atoms, 2 * n_times_atom - 1))
-    t0 = n_times_atom - 1
     for k0 in range(n_atoms):
-        for k in range(n_atoms):
-            for t in range(n_times_atom):
-                if t == 0:
-                    DtD[k0, k, t0] = np.dot(uv[k0, n_channels:],
-                                            uv[k, n_channels:])
-                else:
-                    DtD[k0, k, t0 + t] = np.dot(uv[k0, n_channels:-t],
-                                                uv[k, n_channels + t:])
-                    DtD[k0, k, t0 - t] = np.dot(uv[k0, n_channels + t:],
-                                                uv[k, n_channels:-t])
-    DtD *= np.dot(u, u.T).reshape(n_atoms, n_atoms, 1)
+        _add_DtD_uv_row(DtD, uv, n_channels, k0)
+    return DtD
+
+
+@numba.jit(nopython=True, cache=True, parallel=True)
+def _compute_DtD_uv_parallel(uv, n_channels):  # pragma: no cover
+    n_atoms, n_times_atom = uv.shape
+    n_times_atom -= n_channels
+
+    DtD = np.zeros(shape=(n_atoms, n_atoms, 2 * n_times_atom - 1))
+    for k0 in numba.prange(n_atoms):
+        _add_DtD_uv_row(DtD, uv, n_channels, k0)
     return DtD
 
 
-@numba.jit((numba.float64[:, :, :],), nopython=True, cache=True)
+@numba.jit(nopython=True, cache=True)
+def _add_DtD_D_row(DtD, D, k0):  # pragma: no cover
+    n_atoms, n_channels, n_times_atom = D.shape
+    t0 = n_times_atom - 1
+    for k in range(n_atoms):
+        for t in range(n_times_atom):
+            if t == 0:
+                DtD[k0, k, t0] = np.dot(D[k0].ravel(), D[k].ravel())
+            else:
+                DtD[k0, k, t0 + t] = np.dot(D[k0, :, :-t].ravel(),
+                                            D[k, :, t:].ravel())
+                DtD[k0, k, t0 - t] = np.dot(D[k0, :, t:].ravel(),
+                                            D[k, :, :-t].ravel())
+
+
+@numba.jit([(numba.float64[:, :, :],), (numba.float32[:, :, :],)],
+           nopython=True, cache=True)
 def _compute_DtD_D(D):  # pragma: no cover
     # TODO: benchmark the cross correlate function of numpy
     n_atoms, n_channels, n_times_atom = D.shape
 
     DtD = np.zeros(shape=(n_atoms, n_atoms, 2 * n_times_atom - 1))
-    t0 = n_times_atom - 1
     for k0 in range(n_atoms):
-        for k in range(n_atoms):
-            for t in range(n_times_atom):
-                if t == 0:
-                    DtD[k0, k, t0] = np.dot(D[k0].ravel(), D[k].ravel())
-                else:
-                    DtD[k0, k, t0 + t] = np.dot(D[k0, :, :-t].ravel(),
-                                                D[k, :, t:].ravel())
-                    DtD[k0, k, t0 - t] = np.dot(D[k0, :, t:].ravel(),
-                                                D[k, :, :-t].ravel())
+        _add_DtD_D_row(DtD, D, k0)
     return DtD
 
 
-@numba.jit((numba.float64[:, :, :], numba.int64), nopython=True, cache=True)
-def compute_ztz(z, n_times_atom):  # pragma: no cover
+@numba.jit(nopython=True, cache=True, parallel=True)
+def _compute_DtD_D_parallel(D):  # pragma: no cover
+    n_atoms, n_channels, n_times_atom = D.shape
+
+    DtD = np.zeros(shape=(n_atoms, n_atoms, 2 * n_times_atom - 1))
+    for k0 in numba.prange(n_atoms):
+        _add_DtD_D_row(DtD, D, k0)
+    return DtD
+
+
+def compute_ztz(z, n_times_atom, method='auto'):
     """
     ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
     z.shape = n_trials, n_atoms, n_times - n_times_atom + 1)
+
+    z can also be a list of n_trials sparse matrices of shape
+    (n_atoms, n_times - n_times_atom + 1).
+
+    method : 'auto' | 'sparse' | 'fft' | 'dense'
+        Algorithm used to compute ztz. 'sparse' only iterates over the pairs
+        of non-zero activations less than n_times_atom apart, 'fft' computes
+        the cross-correlations in the Fourier domain and 'dense' loops over
+        all the time lags. If 'auto', the fastest method is selected with a
+        cost model.
+
+    ztz is always a float64 array, even if z is float32.
     """
+    if method == 'auto':
+        method = _get_ztz_method(z, n_times_atom)
+
+    if method == 'sparse':
+        ks, ts, zs, offsets = _get_sparse_activations(z)
+        n_atoms = _get_z_shape(z)[1]
+        return _compute_ztz_sparse(ks, ts, zs, offsets, n_atoms, n_times_atom,
+                                   _get_n_chunks(len(offsets) - 1))
+
+    if is_sparse_z(z):
+        z = np.array([z_i.toarray() for z_i in z])
+    if method == 'fft':
+        return _compute_ztz_fft(z, n_times_atom)
+    elif method == 'dense':
+        z = np.ascontiguousarray(z, dtype=np.float64)
+        if get_numba_n_threads() > 1:
+            return _compute_ztz_dense_parallel(z, n_times_atom)
+        return _compute_ztz_dense(z, n_times_atom)
+    raise ValueError("Unknown method %r for compute_ztz. Must be 'auto', "
+                     "'sparse', 'fft' or 'dense'." % (method, ))
+
+
+@numba.jit(nopython=True, cache=True)
+def _add_ztz_dense_row(ztz, z, k0):  # pragma: no cover
+    n_trials, n_atoms, n_times_valid = z.shape
+    n_times_atom = (ztz.shape[2] + 1) // 2
+    t0 = n_times_atom - 1
+    for i in range(n_trials):
+        for k in range(n_atoms):
+            for t in range(n_times_atom):
+                if t == 0:
+                    ztz[k0, k, t0] += (z[i, k0] * z[i, k]).sum()
+                else:
+                    ztz[k0, k, t0 + t] += (
+                        z[i, k0, :-t] * z[i, k, t:]).sum()
+                    ztz[k0, k, t0 - t] += (
+                        z[i, k0, t:] * z[i, k, :-t]).sum()
+
+
+@numba.jit((numba.float64[:, :, :], numba.int64), nopython=True, cache=True)
+def _compute_ztz_dense(z, n_times_atom):  # pragma: no cover
     # TODO: benchmark the cross correlate function of numpy
     n_trials, n_atoms, n_times_valid = z.shape
 
     ztz = np.zeros(shape=(n_atoms, n_atoms, 2 * n_times_atom - 1))
-    t0 = n_times_atom - 1
-    for i in range(n_trials):
-        for k0 in range(n_atoms):
-            for k in range(n_atoms):
-                for t in range(n_times_atom):
-                    if t == 0:
-                        ztz[k0, k, t0] += (z[i, k0] * z[i, k]).sum()
-                    else:
-                        ztz[k0, k, t0 + t] += (
-                            z[i, k0, :-t] * z[i, k, t:]).sum()
-                        ztz[k0, k, t0 - t] += (
-                            z[i, k0, t:] * z[i, k, :-t]).sum()
+    for k0 in range(n_atoms):
+        _add_ztz_dense_row(ztz, z, k0)
     return ztz
 
 
-def compute_ztX(z, X):
+@numba.jit(nopython=True, cache=True, parallel=True)
+def _compute_ztz_dense_parallel(z, n_times_atom):  # pragma: no cover
+    n_trials, n_atoms, n_times_valid = z.shape
+
+    ztz = np.zeros(shape=(n_atoms, n_atoms, 2 * n_times_atom - 1))
+    for k0 in numba.prange(n_atoms):
+        _add_ztz_dense_row(ztz, z, k0)
+    return ztz
+
+
+def compute_ztX(z, X, method='auto'):
     """
     z.shape = n_trials, n_atoms, n_times - n_times_atom + 1)
     X.shape = n_trials, n_channels, n_times
     ztX.shape = n_atoms, n_channels, n_times_atom
+
+    z can also be a list of n_trials sparse matrices of shape
+    (n_atoms, n_times - n_times_atom + 1).
+
+    method : 'auto' | 'sparse' | 'fft'
+        Algorithm used to compute ztX. 'sparse' iterates over the non-zero
+        activations and 'fft' computes the cross-correlations in the Fourier
+        domain. If 'auto', the fastest method is selected with a cost model.
+
+    ztX is always a float64 array, even if z or X are float32.
     """
-    n_trials, n_atoms, n_times_valid = z.shape
+    if method == 'auto':
+        method = _get_ztX_method(z, X)
+
+    n_trials, n_atoms, n_times_valid = _get_z_shape(z)
+    n_times_atom = X.shape[2] - n_times_valid + 1
+
+    if method == 'sparse':
+        ks, ts, zs, offsets = _get_sparse_activations(z)
+        return _compute_ztX_sparse(ks, ts, zs, offsets, X, n_atoms,
+                                   n_times_atom, _get_n_chunks(n_trials))
+    elif method == 'fft':
+        if is_sparse_z(z):
+            z = np.array([z_i.toarray() for z_i in z])
+        return _compute_ztX_fft(z, X)
+    raise ValueError("Unknown method %r for compute_ztX. Must be 'auto', "
+                     "'sparse' or 'fft'." % (method, ))
+
+
+def is_sparse_z(z):
+    """Return True if z is stored as a list of per-trial sparse matrices."""
+    return isinstance(z, (list, tuple)) and len(z) > 0 and \
+        sparse.issparse(z[0])
+
+
+@numba.jit(nopython=True, cache=True)
+def _add_ztz_sparse(ztz, ks, ts, zs, n_times_atom):  # pragma: no cover
+    """Accumulate in ztz the products of the activations (ks, ts, zs) of one
+    trial that are less than n_times_atom apart. ts should be sorted."""
+    t0 = n_times_atom - 1
+    n_nnz = len(ts)
+    for i in range(n_nnz):
+        ztz[ks[i], ks[i], t0] += zs[i] * zs[i]
+        for j in range(i + 1, n_nnz):
+            dt = ts[j] - ts[i]
+            if dt >= n_times_atom:
+                break
+            ztz[ks[i], ks[j], t0 + dt] += zs[i] * zs[j]
+            ztz[ks[j], ks[i], t0 - dt] += zs[i] * zs[j]
+
+
+def _get_z_shape(z):
+    """Return (n_trials, n_atoms, n_times_valid) for dense or sparse z."""
+    if is_sparse_z(z):
+        return (len(z), ) + z[0].shape
+    return z.shape
+
+
+def _get_z_nnz(z):
+    if is_sparse_z(z):
+        return sum(z_i.nnz for z_i in z)
+    return np.count_nonzero(z)
+
+
+def _get_sparse_activations(z):
+    """Return the non-zero activations of z, sorted by trial and time.
+
+    Returns
+    -------
+    ks, ts, zs : arrays, shape (n_nnz,)
+        Atom index, time index and value of each non-zero activation.
+    offsets : array, shape (n_trials + 1,)
+        The activations of trial i are in the slice offsets[i]:offsets[i + 1].
+    """
+    if is_sparse_z(z):
+        ks, ts, zs = [], [], []
+        for z_i in z:
+            z_i = sparse.coo_matrix(z_i)
+            order = np.argsort(z_i.col, kind='stable')
+            ks.append(z_i.row[order]), ts.append(z_i.col[order])
+            zs.append(z_i.data[order])
+        n_nnz = [len(ts_i) for ts_i in ts]
+        offsets = np.r_[0, np.cumsum(n_nnz)].astype(np.int64)
+        ks, ts, zs = np.concatenate(ks), np.concatenate(ts), np.concatenate(zs)
+    else:
+        trial, ts, ks = np.nonzero(z.transpose(0, 2, 1))
+        zs = z[trial, ks, ts]
+        offsets = np.searchsorted(trial, np.arange(z.shape[0] + 1))
+    return (ks.astype(np.int64), ts.astype(np.int64),
+            zs.astype(np.float64), offsets.astype(np.int64))
+
+
+def _get_n_chunks(n_trials):
+    """Number of chunks of trials processed in parallel by numba."""
+    return max(1, min(n_trials, get_numba_n_threads()))
+
+
+# Rough costs in seconds of the elementary operations of each algorithm,
+# calibrated with benchmarks/function_benchmarks/compute_ztz.py.
+COST_STATS_NNZ = 5e-8
+COST_STATS_PAIR = 1.5e-8
+COST_STATS_SLICE_FLOP = 3e-9
+COST_STATS_DENSE_FLOP = 2e-9
+COST_STATS_FFT_FLOP = 1e-9
+
+
+def _get_ztz_method(z, n_times_atom):
+    """Select the fastest algorithm to compute ztz with a simple cost model.
+    """
+    n_trials, n_atoms, n_times_valid = _get_z_shape(z)
+    nnz = _get_z_nnz(z)
+    n_fft = fft.next_fast_len(n_times_valid + n_times_atom - 1, real=True)
+    fft_flops = n_fft * np.log2(n_fft)
+
+    # expected number of pairs of activations less than n_times_atom apart
+    density = nnz / (n_trials * n_times_valid)
+    n_pairs = nnz * min(density * n_times_atom, nnz / n_trials)
+    costs = dict(
+        sparse=COST_STATS_NNZ * nnz + COST_STATS_PAIR * n_pairs,
+        dense=COST_STATS_DENSE_FLOP * (
+            2 * n_trials * n_atoms ** 2 * n_times_atom * n_times_valid),
+        fft=COST_STATS_FFT_FLOP * (
+            (n_trials * n_atoms + n_atoms ** 2) * fft_flops +
+            4 * n_trials * n_atoms ** 2 * n_fft)
+    )
+    if is_sparse_z(z):
+        # avoid densifying z unless it is much cheaper
+        costs['fft'] += COST_STATS_FFT_FLOP * n_trials * n_atoms * n_fft
+        del costs['dense']
+    return min(costs, key=costs.get)
+
+
+def _get_ztX_method(z, X):
+    """Select the fastest algorithm to compute ztX with a simple cost model.
+    """
+    n_trials, n_atoms, n_times_valid = _get_z_shape(z)
     _, n_channels, n_times = X.shape
     n_times_atom = n_times - n_times_valid + 1
+    nnz = _get_z_nnz(z)
+    n_fft = fft.next_fast_len(n_times, real=True)
+    fft_flops = n_fft * np.log2(n_fft)
+
+    costs = dict(
+        sparse=nnz * (COST_STATS_NNZ +
+                      COST_STATS_SLICE_FLOP * n_channels * n_times_atom),
+        fft=COST_STATS_FFT_FLOP * (
+            (n_trials * (n_atoms + n_channels) + n_atoms * n_channels) *
+            fft_flops + 4 * n_trials * n_atoms * n_channels * n_fft)
+    )
+    return min(costs, key=costs.get)
 
-    ztX = np.zeros((n_atoms, n_channels, n_times_atom))
-    for n, k, t in zip(*z.nonzero()):
-        ztX[k, :, :] += z[n, k, t] * X[n, :, t:t + n_times_atom]
 
-    return ztX
+@numba.jit(nopython=True, cache=True, parallel=True)
+def _compute_ztz_sparse(ks, ts, zs, offsets, n_atoms, n_times_atom,
+                        n_chunks):  # pragma: no cover
+    """Compute ztz from the activations returned by _get_sparse_activations.
+
+    The trials are split in n_chunks chunks processed in parallel, each with
+    its own accumulator to avoid race conditions.
+    """
+    n_trials = len(offsets) - 1
+    ztz_chunks = np.zeros((n_chunks, n_atoms, n_atoms, 2 * n_times_atom - 1))
+    for c in numba.prange(n_chunks):
+        for i in range(c, n_trials, n_chunks):
+            start, stop = offsets[i], offsets[i + 1]
+            _add_ztz_sparse(ztz_chunks[c], ks[start:stop], ts[start:stop],
+                            zs[start:stop], n_times_atom)
+    return ztz_chunks.sum(axis=0)
+
+
+@numba.jit(nopython=True, cache=True, parallel=True)
+def _compute_ztX_sparse(ks, ts, zs, offsets, X, n_atoms, n_times_atom,
+                        n_chunks):  # pragma: no cover
+    """Compute ztX from the activations returned by _get_sparse_activations.
+    """
+    n_trials, n_channels, _ = X.shape
+    ztX_chunks = np.zeros((n_chunks, n_atoms, n_channels, n_times_atom))
+    for c in numba.prange(n_chunks):
+        for i in range(c, n_trials, n_chunks):
+            for j in range(offsets[i], offsets[i + 1]):
+                ztX_chunks[c, ks[j]] += zs[j] * X[i, :, ts[j]:ts[j] +
+                                                  n_times_atom]
+    return ztX_chunks.sum(axis=0)
+
+
+def _compute_ztz_fft(z, n_times_atom):
+    """Compute ztz with cross-correlations in the Fourier domain."""
+    n_trials, n_atoms, n_times_valid = z.shape
+    # zero-padding to avoid the circular wrap of the lags up to n_times_atom
+    n_fft = fft.next_fast_len(n_times_valid + n_times_atom - 1, real=True)
+    # accumulate the trials in the Fourier domain, one trial at a time to
+    # bound the memory used by the transforms. Each trial is cast to float64
+    # so that float32 codes are also accumulated in double precision.
+    ztz_hat = 0
+    for z_i in z:
+        z_hat = fft.rfft(z_i.astype(np.float64, copy=False), n_fft)
+        ztz_hat += np.einsum('kf,lf->klf', z_hat.conj(), z_hat)
+    ztz = fft.irfft(ztz_hat, n_fft)
+    return np.concatenate([ztz[:, :, n_fft - n_times_atom + 1:],
+                           ztz[:, :, :n_times_atom]], axis=2)
+
+
+def _compute_ztX_fft(z, X):
+    """Compute ztX with cross-correlations in the Fourier domain."""
+    n_trials, n_atoms, n_times_valid = z.shape
+    n_times = X.shape[2]
+    n_times_atom = n_times - n_times_valid + 1
+    n_fft = fft.next_fast_len(n_times, real=True)
+    ztX_hat = 0
+    for z_i, X_i in zip(z, X):
+        z_hat = fft.rfft(z_i.astype(np.float64, copy=False), n_fft)
+        X_hat = fft.rfft(X_i.astype(np.float64, copy=False), n_fft)
+        ztX_hat += np.einsum('kf,cf->kcf', z_hat.conj(), X_hat)
+    return fft.irfft(ztX_hat, n_fft)[:, :, :n_times_atom]
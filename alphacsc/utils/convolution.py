@@ -8,8 +8,21 @@
 
 import numba
 import numpy as np
+from scipy import fft, sparse
 
 from .dictionary import get_D_shape
+from .parallel import get_numba_n_threads
+
+
+# Rough per-operation costs (in seconds) used by the cost model of
+# _get_convolve_method. The constant terms account for the python overhead of
+# each call of np.convolve / each iteration on a non-zero activation.
+COST_SPARSE_NNZ = 5e-6
+COST_SPARSE_FLOP = 3e-9
+COST_DENSE_CALL = 1e-5
+COST_DENSE_FLOP = 5e-10
+COST_FFT_CALL = 5e-5
+COST_FFT_FLOP = 1.1e-9
 
 
 def construct_X(z, ds):
@@ -55,7 +68,11 @@ def construct_X_multi(z, D=None, n_channels=None):
     -------
     X : array, shape (n_trials, n_channels, n_times)
     """
-    n_trials, n_atoms, n_times_valid = z.shape
+    if isinstance(z, (list, tuple)):
+        n_trials = len(z)
+        n_atoms, n_times_valid = z[0].shape
+    else:
+        n_trials, n_atoms, n_times_valid = z.shape
     assert n_atoms == D.shape[0]
     _, n_channels, n_times_atom = get_D_shape(D, n_channels)
     n_times = n_times_valid + n_times_atom - 1
@@ -78,6 +95,27 @@ def _sparse_convolve(z_i, ds):
     return Xi
 
 
+def _sparse_matrix_convolve_multi(z_i, D, n_channels):
+    """Same as _sparse_convolve_multi, for a scipy.sparse z_i."""
+    _, n_channels, n_times_atom = get_D_shape(D, n_channels)
+    n_atoms, n_times_valid = z_i.shape
+    n_times = n_times_valid + n_times_atom - 1
+    z_i = sparse.coo_matrix(z_i)
+
+    Xi = np.zeros(shape=(n_channels, n_times))
+    if D.ndim == 2:
+        # accumulate the temporal patterns per atom, then apply u_k
+        zv = np.zeros((n_atoms, n_times))
+        v = D[:, n_channels:]
+        for k, t, z_ikt in zip(z_i.row, z_i.col, z_i.data):
+            zv[k, t:t + n_times_atom] += z_ikt * v[k]
+        Xi += np.dot(D[:, :n_channels].T, zv)
+    else:
+        for k, t, z_ikt in zip(z_i.row, z_i.col, z_i.data):
+            Xi[:, t:t + n_times_atom] += z_ikt * D[k]
+    return Xi
+
+
 def _sparse_convolve_multi(z_i, ds):
     """Same as _dense_convolve, but use the sparsity of zi."""
     n_atoms, n_channels, n_times_atom = ds.shape
@@ -153,9 +191,104 @@ def _choose_convolve(z_i, ds):
         return _dense_convolve(z_i, ds)
 
 
+def _get_convolve_method(nnz, n_atoms, n_channels, n_times_valid,
+                         n_times_atom, rank1, transpose=False):
+    """Select the fastest convolution method with a simple cost model.
+
+    Parameters
+    ----------
+    nnz : int
+        Number of non-zero activations. Ignored if transpose is True.
+    n_atoms, n_channels, n_times_valid, n_times_atom : int
+        Dimensions of the problem.
+    rank1 : boolean
+        If True, the dictionary is a rank 1 dictionary uv.
+    transpose : boolean
+        If True, select the method for the transposed convolution, used to
+        compute the gradient relative to z. Only 'dense' and 'fft' are
+        available in this case.
+
+    Returns
+    -------
+    method : str in {'sparse' | 'dense' | 'fft'}
+    """
+    n_times = n_times_valid + n_times_atom - 1
+    n_fft = fft.next_fast_len(n_times, real=True)
+    fft_flops = n_fft * np.log2(n_fft)
+    if rank1:
+        # the spatial maps u are applied once, whatever the method, so each
+        # atom only involves one temporal convolution.
+        n_conv_channels = 1
+        n_transforms = 2 * n_atoms
+    else:
+        n_conv_channels = n_channels
+        n_transforms = n_atoms * n_channels + n_atoms + n_channels
+
+    costs = dict(
+        dense=n_atoms * n_conv_channels * (
+            COST_DENSE_CALL + COST_DENSE_FLOP * n_times_valid * n_times_atom
+        ),
+        fft=COST_FFT_CALL + COST_FFT_FLOP * n_transforms * fft_flops
+    )
+    if not transpose:
+        costs['sparse'] = nnz * (
+            COST_SPARSE_NNZ + COST_SPARSE_FLOP * n_conv_channels * n_times_atom
+        )
+    return min(costs, key=costs.get)
+
+
+def _fft_convolve_multi(z_i, D, n_channels=None):
+    """Convolve z_i[k] and D[k] for each atom k in the Fourier domain, and
+    return the sum."""
+    n_atoms, n_times_valid = z_i.shape
+    _, n_channels, n_times_atom = get_D_shape(D, n_channels)
+    n_times = n_times_valid + n_times_atom - 1
+    n_fft = fft.next_fast_len(n_times, real=True)
+
+    z_i_hat = fft.rfft(z_i, n_fft)
+    if D.ndim == 2:
+        v_hat = fft.rfft(D[:, n_channels:], n_fft)
+        zv = fft.irfft(z_i_hat * v_hat, n_fft)[:, :n_times]
+        return np.dot(D[:, :n_channels].T, zv)
+
+    D_hat = fft.rfft(D, n_fft)
+    Xi_hat = np.einsum('kf,kpf->pf', z_i_hat, D_hat)
+    return fft.irfft(Xi_hat, n_fft)[:, :n_times]
+
+
+def _fft_transpose_convolve_d(residual_i, D, n_channels=None):
+    """Correlate residual_i with D[k] for each atom k in the Fourier domain.
+
+    Parameters
+    ----------
+    residual_i : array, shape (n_channels, n_times)
+    D : array, shape (n_atoms, n_channels, n_times_atom) or
+               shape (n_atoms, n_channels + n_times_atom)
+
+    Return
+    ------
+    grad_zi : array, shape (n_atoms, n_times_valid)
+    """
+    n_channels, n_times = residual_i.shape
+    *_, n_times_atom = get_D_shape(D, n_channels)
+    n_times_valid = n_times - n_times_atom + 1
+    # No wrap around for the valid part of the correlation as n_fft >= n_times
+    n_fft = fft.next_fast_len(n_times, real=True)
+
+    if D.ndim == 2:
+        uR_i = np.dot(D[:, :n_channels], residual_i)
+        grad_hat = fft.rfft(uR_i, n_fft) * np.conj(
+            fft.rfft(D[:, n_channels:], n_fft))
+    else:
+        grad_hat = np.einsum('pf,kpf->kf', fft.rfft(residual_i, n_fft),
+                             np.conj(fft.rfft(D, n_fft)))
+    return fft.irfft(grad_hat, n_fft)[:, :n_times_valid]
+
+
 def _choose_convolve_multi(z_i, D=None, n_channels=None):
-    """Choose between _dense_convolve and _sparse_convolve with a heuristic
-    on the sparsity of z_i, and perform the convolution.
+    """Choose between _dense_convolve, _sparse_convolve and
+    _fft_convolve_multi with a cost model based on the sparsity of z_i and
+    the problem dimensions, and perform the convolution.
 
     z_i : array, shape(n_atoms, n_times_valid)
         Activations
@@ -168,12 +301,25 @@ def _choose_convolve_multi(z_i, D=None, n_channels=None):
     """
     assert z_i.shape[0] == D.shape[0]
 
-    if np.sum(z_i != 0) < 0.01 * z_i.size:
+    if sparse.issparse(z_i):
+        return _sparse_matrix_convolve_multi(z_i, D, n_channels)
+
+    n_atoms, n_times_valid = z_i.shape
+    _, n_channels, n_times_atom = get_D_shape(D, n_channels)
+    method = _get_convolve_method(
+        np.count_nonzero(z_i), n_atoms, n_channels, n_times_valid,
+        n_times_atom, rank1=(D.ndim == 2)
+    )
+
+    if method == 'sparse':
         if D.ndim == 2:
             return _sparse_convolve_multi_uv(z_i, D, n_channels)
         else:
             return _sparse_convolve_multi(z_i, D)
 
+    elif method == 'fft':
+        return _fft_convolve_multi(z_i, D, n_channels)
+
     else:
         if D.ndim == 2:
             return _dense_convolve_multi_uv(z_i, D, n_channels)
@@ -181,11 +327,12 @@ def _choose_convolve_multi(z_i, D=None, n_channels=None):
             return _dense_convolve_multi(z_i, D)
 
 
-@numba.jit((numba.float64[:, :, :], numba.float64[:, :]), cache=True,
-           nopython=True)
 def numpy_convolve_uv(ztz, uv):
     """Compute the multivariate (valid) convolution of ztz and D
 
+    The atoms are split between the numba threads, see
+    alphacsc.utils.parallel.numba_threads.
+
     Parameters
     ----------
     ztz: array, shape = (n_atoms, n_atoms, 2 * n_times_atom - 1)
@@ -199,6 +346,25 @@ def numpy_convolve_uv(ztz, uv):
         Gradient
     """
     assert uv.ndim == 2
+    if get_numba_n_threads() > 1:
+        return _numpy_convolve_uv_parallel(ztz, uv)
+    return _numpy_convolve_uv(ztz, uv)
+
+
+@numba.jit(nopython=True, cache=True)
+def _add_convolve_uv_row(G, ztz, u, v, k0):  # pragma: no cover
+    n_atoms = ztz.shape[0]
+    n_times_atom = G.shape[2]
+    for k1 in range(n_atoms):
+        for t in range(n_times_atom):
+            G[k0, :, t] += (
+                np.sum(ztz[k0, k1, t:t + n_times_atom] * v[k1]) * u[k1, :])
+
+
+@numba.jit([(numba.float64[:, :, :], numba.float64[:, :]),
+            (numba.float64[:, :, :], numba.float32[:, :])], cache=True,
+           nopython=True)
+def _numpy_convolve_uv(ztz, uv):  # pragma: no cover
     n_times_atom = (ztz.shape[2] + 1) // 2
     n_atoms = ztz.shape[0]
     n_channels = uv.shape[1] - n_times_atom
@@ -208,10 +374,23 @@ def numpy_convolve_uv(ztz, uv):
 
     G = np.zeros((n_atoms, n_channels, n_times_atom))
     for k0 in range(n_atoms):
-        for k1 in range(n_atoms):
-            for t in range(n_times_atom):
-                G[k0, :, t] += (
-                    np.sum(ztz[k0, k1, t:t + n_times_atom] * v[k1]) * u[k1, :])
+        _add_convolve_uv_row(G, ztz, u, v, k0)
+
+    return G
+
+
+@numba.jit(nopython=True, cache=True, parallel=True)
+def _numpy_convolve_uv_parallel(ztz, uv):  # pragma: no cover
+    n_times_atom = (ztz.shape[2] + 1) // 2
+    n_atoms = ztz.shape[0]
+    n_channels = uv.shape[1] - n_times_atom
+
+    u = uv[:, :n_channels]
+    v = uv[:, n_channels:][:, ::-1]
+
+    G = np.zeros((n_atoms, n_channels, n_times_atom))
+    for k0 in numba.prange(n_atoms):
+        _add_convolve_uv_row(G, ztz, u, v, k0)
 
     return G
 
@@ -243,13 +422,24 @@ def tensordot_convolve(ztz, D):
 
 def sort_atoms_by_explained_variances(D_hat, z_hat, n_channels):
     n_atoms = D_hat.shape[0]
-    assert z_hat.shape[1] == n_atoms
+    is_list = isinstance(z_hat, (list, tuple))
+    if is_list:
+        z_hat = [sparse.csr_matrix(z_i) for z_i in z_hat]
+        assert z_hat[0].shape[0] == n_atoms
+    else:
+        assert z_hat.shape[1] == n_atoms
     variances = np.zeros(n_atoms)
     for kk in range(n_atoms):
-        variances[kk] = construct_X_multi(z_hat[:, kk:kk + 1],
-                                          D_hat[kk:kk + 1],
+        if is_list:
+            z_k = [z_i[kk:kk + 1] for z_i in z_hat]
+        else:
+            z_k = z_hat[:, kk:kk + 1]
+        variances[kk] = construct_X_multi(z_k, D_hat[kk:kk + 1],
                                           n_channels=n_channels).var()
     order = np.argsort(variances)[::-1]
-    z_hat = z_hat[:, order, :]
+    if is_list:
+        z_hat = [z_i[order] for z_i in z_hat]
+    else:
+        z_hat = z_hat[:, order, :]
     D_hat = D_hat[order, ...]
     return D_hat, z_hat
@@ -1,18 +1,23 @@
 # Authors: Thomas Moreau <thomas.moreau@inria.fr>
 
 import time
+
+import numba
 import numpy as np
 
 from . import check_random_state
 from .dictionary import get_D_shape
 from ..loss_and_gradient import gradient_zi
 from .convolution import _choose_convolve_multi
+from .screening import gap_safe_screening
 
 
 def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
                             tol=1e-3, strategy='greedy', n_seg='auto',
                             freeze_support=False, debug=False, timing=False,
-                            random_state=None, name="CD", verbose=0):
+                            use_numba=False, random_state=None, name="CD",
+                            verbose=0, ztz=None, ztX=None, screening=False,
+                            screen_every=10, stats=None):
     """Compute the coding signal associated to Xi with coordinate descent.
 
     Parameters
@@ -41,6 +46,31 @@ def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
     debug : boolean
         Activate extra check in the algorithm to assert that we have
         implemented the correct algorithm.
+    use_numba : boolean
+        If set to True, run the coordinate descent loop in a compiled numba
+        kernel. The result is identical to the python loop for the 'greedy'
+        and 'cyclic' strategies. This option is ignored when timing or debug
+        are set to True.
+    ztz : array, shape (n_atoms, n_atoms, 2 * n_times_atom - 1) | None
+        If not None, ztz is updated inplace after each coordinate update with
+        the variation of the statistic z_hat.T z_hat. Starting from the ztz of
+        z0 (or from zeros to get the variation), this maintains the
+        statistics at a cost proportional to the number of coordinate updates
+        instead of recomputing them from scratch. ztX must also be given.
+    ztX : array, shape (n_atoms, n_channels, n_times_atom) | None
+        If not None, ztX is updated inplace like ztz, with the variation of
+        the statistic z_hat.T Xi.
+    screening : boolean
+        If True, the coordinates that are provably zero at the optimum are
+        discarded with the gap safe screening rule, before the descent and
+        every screen_every passes over the segments. It is ignored when reg
+        is not positive.
+    screen_every : int
+        Number of passes over the segments between two screenings.
+    stats : dict | None
+        If not None and screening is True, it is filled with the number of
+        coordinates 'n_coordinates', the number of screened coordinates
+        'n_screened' and the duality gap at the last screening 'gap'.
     """
     if timing:
         t_start = time.time()
@@ -50,10 +80,11 @@ def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
     t0 = n_times_atom - 1
 
     if z0 is None:
-        z_hat = np.zeros((n_atoms, n_times_valid))
+        z_hat = np.zeros((n_atoms, n_times_valid), dtype=Xi.dtype)
     else:
         z_hat = z0.copy()
 
+    n_coordinates = n_times_valid * n_atoms
     n_times_seg = 2 * np.array(n_times_atom) - 1
     if n_seg == 'auto':
         if strategy == 'greedy':
@@ -61,7 +92,7 @@ def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
                         ((n_times_valid % n_times_seg) != 0))
         elif strategy in ('random', 'cyclic'):
             n_seg = 1
-            n_coordinates = n_times_valid * n_atoms
+            n_times_seg = n_times_valid
     else:
         n_times_seg = n_times_valid // n_seg + ((n_times_valid % n_seg) != 0)
 
@@ -93,6 +124,80 @@ def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
         mask = z0 == 0
         dz_opt[mask] = 0
 
+    update_stats = ztz is not None
+    if update_stats:
+        assert ztX is not None, "ztX should be given with ztz."
+        ztz_rows = np.zeros(ztz.shape)
+    else:
+        ztz_rows = ztX = np.zeros((0, 0, 0))
+
+    reg_k = np.empty(n_atoms)
+    reg_k[:] = np.ravel(reg)
+    screening = screening and np.all(reg_k > 0)
+    n_screened, gap = 0, None
+    if screening:
+        # The screened coordinates are frozen to zero, like the coordinates
+        # outside the support of z0 with freeze_support. support is 0 for
+        # all the frozen coordinates.
+        support = np.ones(z_hat.shape, dtype=z_hat.dtype)
+        if freeze_support:
+            support[z0 == 0] = 0
+        freeze_support = True
+        # beta is the gradient D^T (D z - X) without the diagonal terms, so
+        # D^T X is obtained from DtD without any convolution.
+        DtX = _compute_DtDz(z_hat, DtD) - beta - z_hat * norm_Dk
+        XtX = np.dot(Xi.ravel(), Xi.ravel().astype(np.float64))
+
+        def screen():
+            n_new, gap = _screen(Xi, z_hat, beta, dz_opt, support, DtD,
+                                 norm_Dk, reg_k, DtX, XtX, update_stats,
+                                 ztz_rows, ztX)
+            return n_screened + n_new, gap
+
+        n_screened, gap = screen()
+    else:
+        support = z0
+
+    if use_numba and not (timing or debug):
+        if strategy not in _STRATEGIES:
+            raise ValueError("'The coordinate selection method should be in "
+                             "{'greedy' | 'random' | 'cyclic'}. Got '%s'."
+                             % (strategy, ))
+        if support is None:
+            support = np.zeros(z_hat.shape, dtype=z_hat.dtype)
+        max_iter = int(min(max_iter, np.iinfo(np.int64).max))
+        # With screening, the descent is interrupted to screen the
+        # coordinates every screen_every passes over the segments.
+        max_iter_round = max_iter
+        if screening:
+            max_iter_round = int(screen_every * n_seg)
+        n_iter = 0
+        while n_iter < max_iter:
+            n_iter_round = min(max_iter_round, max_iter - n_iter)
+            n_iter_done = _coordinate_descent_compiled(
+                z_hat, beta, dz_opt, DtD, norm_Dk.ravel(), reg_k, tol,
+                n_iter_round, _STRATEGIES[strategy], n_seg,
+                int(n_times_seg), n_coordinates, n_times_atom,
+                freeze_support, support, rng.randint(2**31 - 1),
+                update_stats, ztz_rows, ztX, Xi
+            )
+            n_iter += n_iter_done
+            if n_iter_done < n_iter_round:
+                break
+            if screening:
+                n_screened, gap = screen()
+        if verbose > 10:
+            if n_iter < max_iter:
+                print('[{}] {} iterations'.format(name, n_iter))
+            else:
+                print('[{}] did not converge'.format(name))
+        if update_stats:
+            ztz += ztz_rows + _mirror_ztz(ztz_rows)
+        if stats is not None and screening:
+            stats.update(n_coordinates=n_coordinates,
+                         n_screened=n_screened, gap=gap)
+        return z_hat
+
     accumulator = n_seg
     active_segs = np.array([True] * n_seg)
     i_seg = 0
@@ -114,12 +219,14 @@ def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
         if abs(dz) > tol:
             # update the selected coordinate
             z_hat[k0, t0] += dz
+            if update_stats:
+                _update_ztz_ztX(ztz_rows, ztX, z_hat, Xi, dz, k0, t0)
 
             # update beta
             beta, dz_opt, accumulator, active_segs = _update_beta(
                 beta, dz_opt, accumulator, active_segs, z_hat, DtD, norm_Dk,
-                dz, k0, t0, reg, tol, seg_bounds, i_seg, n_times_atom, z0,
-                freeze_support, debug)
+                dz, k0, t0, reg, tol, seg_bounds, i_seg, n_times_atom,
+                support, freeze_support, debug)
 
         elif active_segs[i_seg]:
             accumulator -= 1
@@ -130,6 +237,13 @@ def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
             pobj.append(objective(z_hat))
             t_start = time.time()
 
+        if screening and (ii + 1) % (screen_every * n_seg) == 0:
+            n_screened, gap = screen()
+            if strategy == 'greedy':
+                # the screened coordinates can change beta in any segment
+                active_segs[:] = True
+                accumulator = n_seg
+
         # check stopping criterion
         if strategy == 'greedy':
             if accumulator == 0:
@@ -157,6 +271,13 @@ def _coordinate_descent_idx(Xi, D, constants, reg, z0=None, max_iter=1000,
         if verbose > 10:
             print('[{}] did not converge'.format(name))
 
+    if update_stats:
+        ztz += ztz_rows + _mirror_ztz(ztz_rows)
+
+    if stats is not None and screening:
+        stats.update(n_coordinates=n_coordinates, n_screened=n_screened,
+                     gap=gap)
+
     if timing:
         return z_hat, pobj, times
     return z_hat
@@ -174,9 +295,82 @@ def _init_beta(Xi, z_hat, D, constants, reg, norm_Dk, tol):
 
     tol = tol * np.std(Xi)
 
+    # DtD is float64, keep beta and dz_opt in the precision of z_hat
+    beta = beta.astype(z_hat.dtype, copy=False)
+    dz_opt = dz_opt.astype(z_hat.dtype, copy=False)
+
     return beta, dz_opt, tol
 
 
+def _screen(Xi, z_hat, beta, dz_opt, support, DtD, norm_Dk, reg, DtX, XtX,
+            update_stats, ztz_rows, ztX):
+    """Screen the coordinates with the gap safe rule.
+
+    The newly screened coordinates are set to zero, with the corresponding
+    updates of beta, dz_opt and the statistics, and removed from support.
+    Returns the number of newly screened coordinates and the duality gap.
+    """
+    grad = beta + z_hat * norm_Dk
+    screened, gap = gap_safe_screening(z_hat, grad, DtX, XtX, reg[:, None],
+                                       norm_Dk)
+    ks, ts = np.nonzero(screened & (support != 0))
+    support[ks, ts] = 0
+    _zero_coordinates(z_hat, beta, dz_opt, DtD, norm_Dk.ravel(), reg, support,
+                      ks, ts, update_stats, ztz_rows, ztX, Xi)
+    return len(ks), gap
+
+
+@numba.njit(cache=True)
+def _compute_DtDz(z_hat, DtD):  # pragma: no cover
+    """Compute D^T D z from DtD, with a cost proportional to nnz(z)."""
+    n_atoms, n_times_valid = z_hat.shape
+    n_times_atom = (DtD.shape[2] + 1) // 2
+    DtDz = np.zeros((n_atoms, n_times_valid))
+    for k0 in range(n_atoms):
+        for t0 in range(n_times_valid):
+            if z_hat[k0, t0] == 0:
+                continue
+            t_start_up = max(0, t0 - n_times_atom + 1)
+            t_end_up = min(t0 + n_times_atom, n_times_valid)
+            for k in range(n_atoms):
+                for t in range(t_start_up, t_end_up):
+                    DtDz[k, t] += DtD[k, k0, t - t0 + n_times_atom - 1] * (
+                        z_hat[k0, t0])
+    return DtDz
+
+
+@numba.njit(cache=True)
+def _zero_coordinates(z_hat, beta, dz_opt, DtD, norm_Dk, reg, support, ks,
+                      ts, update_stats, ztz_rows, ztX, Xi):  # pragma: no cover
+    """Set the coordinates (ks, ts) to zero and update beta and dz_opt."""
+    n_atoms, n_times_valid = z_hat.shape
+    n_times_atom = (DtD.shape[2] + 1) // 2
+    for i in range(len(ks)):
+        k0, t0 = ks[i], ts[i]
+        dz_opt[k0, t0] = 0
+        dz = -z_hat[k0, t0]
+        if dz == 0:
+            continue
+        z_hat[k0, t0] = 0
+        if update_stats:
+            _update_ztz_ztX(ztz_rows, ztX, z_hat, Xi, dz, k0, t0)
+
+        t_start_up = max(0, t0 - n_times_atom + 1)
+        t_end_up = min(t0 + n_times_atom, n_times_valid)
+        beta_i0 = beta[k0, t0]
+        for k in range(n_atoms):
+            for t in range(t_start_up, t_end_up):
+                beta[k, t] += DtD[k, k0, t - t0 + n_times_atom - 1] * dz
+        beta[k0, t0] = beta_i0
+        for k in range(n_atoms):
+            for t in range(t_start_up, t_end_up):
+                if support[k, t] == 0:
+                    dz_opt[k, t] = 0
+                else:
+                    dz_opt[k, t] = (max(-beta[k, t] - reg[k], 0.)
+                                    / norm_Dk[k] - z_hat[k, t])
+
+
 def _update_beta(beta, dz_opt, accumulator, active_segs, z_hat, DtD, norm_Dk,
                  dz, k0, t0, reg, tol, seg_bounds, i_seg, n_times_atom, z0,
                  freeze_support, debug):
@@ -201,10 +395,12 @@ def _update_beta(beta, dz_opt, accumulator, active_segs, z_hat, DtD, norm_Dk,
     # reunable greedy updates in the segments immediately before or after
     # if beta was update outside the segment
     t_start_seg, t_end_seg = seg_bounds
-    if t_start_up < t_start_seg and not active_segs[i_seg - 1]:
+    if (t_start_up < t_start_seg and i_seg > 0
+            and not active_segs[i_seg - 1]):
         accumulator += 1
         active_segs[i_seg - 1] = True
-    if t_end_up > t_end_seg and not active_segs[i_seg + 1]:
+    if (t_end_up > t_end_seg and i_seg + 1 < len(active_segs)
+            and not active_segs[i_seg + 1]):
         accumulator += 1
         active_segs[i_seg + 1] = True
 
@@ -256,3 +452,144 @@ def _select_coordinate(strategy, dz_opt, active_seg, n_atoms, n_times_valid,
                          "{'greedy' | 'random' | 'cyclic'}. Got '%s'."
                          % (strategy, ))
     return k0, t0, dz
+
+
+@numba.njit(cache=True)
+def _update_ztz_ztX(ztz_rows, ztX, z_hat, Xi, dz, k0, t0):  # pragma: no cover
+    """Update the statistics after z_hat[k0, t0] has been increased by dz.
+
+    The variation of ztz is symmetric, ztz[k, k0, t_lag0 - tau] changing as
+    ztz[k0, k, t_lag0 + tau], so only the rows k0 are accumulated in ztz_rows
+    and the variation of ztz is ztz_rows + _mirror_ztz(ztz_rows). The cost is
+    O(n_atoms * n_times_atom + n_channels * n_times_atom).
+    """
+    n_atoms, n_times_valid = z_hat.shape
+    n_times_atom = ztX.shape[2]
+    t_lag0 = n_times_atom - 1
+    t_start = max(0, t0 - t_lag0)
+    t_end = min(t0 + n_times_atom, n_times_valid)
+    for k in range(n_atoms):
+        for t in range(t_start, t_end):
+            ztz_rows[k0, k, t_lag0 + t - t0] += dz * z_hat[k, t]
+    # With the updated z_hat, the product of (k0, t0) with itself is
+    # counted twice with dz * z_hat[k0, t0], which gives an extra dz ** 2.
+    ztz_rows[k0, k0, t_lag0] -= .5 * dz * dz
+    ztX[k0] += dz * Xi[:, t0:t0 + n_times_atom]
+
+
+def _mirror_ztz(ztz):
+    """Return the array M with M[k0, k, t_lag0 + tau] = ztz[k, k0, t_lag0 -
+    tau]. ztz computed from z is invariant by this operation."""
+    return ztz.transpose(1, 0, 2)[:, :, ::-1]
+
+
+# Integer codes of the coordinate selection strategies for the numba kernel.
+_STRATEGIES = {'greedy': 0, 'random': 1, 'cyclic': 2}
+
+
+@numba.njit(cache=True)
+def _coordinate_descent_compiled(z_hat, beta, dz_opt, DtD, norm_Dk, reg, tol,
+                                 max_iter, strategy, n_seg, n_times_seg,
+                                 n_coordinates, n_times_atom, freeze_support,
+                                 z0, seed, update_stats, ztz_rows, ztX,
+                                 Xi):  # pragma: no cover
+    """Compiled version of the main loop of _coordinate_descent_idx.
+
+    z_hat, beta and dz_opt are updated inplace, as well as ztz_rows and ztX
+    if update_stats is True (see _update_ztz_ztX). reg and norm_Dk are arrays
+    of shape (n_atoms,) and strategy is an integer code from _STRATEGIES.
+    Returns the number of iterations performed.
+    """
+    n_atoms, n_times_valid = z_hat.shape
+    np.random.seed(seed)
+
+    accumulator = float(n_seg)
+    active_segs = np.ones(n_seg, dtype=np.bool_)
+    i_seg = 0
+    t_start_seg, t_end_seg = 0, n_times_seg
+    k0, t0 = 0, -1
+
+    for ii in range(max_iter):
+        # Pick a coordinate to update
+        dz = 0.
+        if strategy == 1:
+            k0 = np.random.randint(n_atoms)
+            t0 = np.random.randint(n_times_valid)
+            dz = dz_opt[k0, t0]
+        elif strategy == 2:
+            t0 += 1
+            if t0 >= n_times_valid:
+                t0 = 0
+                k0 += 1
+                if k0 >= n_atoms:
+                    k0 = 0
+            dz = dz_opt[k0, t0]
+        elif active_segs[i_seg]:
+            adz_max = -1.
+            for k in range(n_atoms):
+                for t in range(t_start_seg, min(t_end_seg, n_times_valid)):
+                    if abs(dz_opt[k, t]) > adz_max:
+                        adz_max = abs(dz_opt[k, t])
+                        k0, t0 = k, t
+            dz = dz_opt[k0, t0]
+
+        if strategy != 0:
+            # accumulate on all coordinates from the stopping criterion
+            if ii % n_coordinates == 0:
+                accumulator = 0.
+            accumulator += abs(dz)
+
+        if abs(dz) > tol:
+            z_hat[k0, t0] += dz
+            if update_stats:
+                _update_ztz_ztX(ztz_rows, ztX, z_hat, Xi, dz, k0, t0)
+
+            # update beta and dz_opt in the neighborhood of t0
+            t_start_up = max(0, t0 - n_times_atom + 1)
+            t_end_up = min(t0 + n_times_atom, n_times_valid)
+            offset = max(0, n_times_atom - t0 - 1) - t_start_up
+            beta_i0 = beta[k0, t0]
+            for k in range(n_atoms):
+                for t in range(t_start_up, t_end_up):
+                    beta[k, t] += DtD[k, k0, offset + t] * dz
+            beta[k0, t0] = beta_i0
+            for k in range(n_atoms):
+                for t in range(t_start_up, t_end_up):
+                    if freeze_support and z0[k, t] == 0:
+                        dz_opt[k, t] = 0
+                    else:
+                        dz_opt[k, t] = (max(-beta[k, t] - reg[k], 0.)
+                                        / norm_Dk[k] - z_hat[k, t])
+            dz_opt[k0, t0] = 0
+
+            # re-enable greedy updates in the segments immediately before or
+            # after if beta was updated outside the segment
+            if (t_start_up < t_start_seg and i_seg > 0
+                    and not active_segs[i_seg - 1]):
+                accumulator += 1
+                active_segs[i_seg - 1] = True
+            if (t_end_up > t_end_seg and i_seg + 1 < n_seg
+                    and not active_segs[i_seg + 1]):
+                accumulator += 1
+                active_segs[i_seg + 1] = True
+
+        elif active_segs[i_seg]:
+            accumulator -= 1
+            active_segs[i_seg] = False
+
+        # check stopping criterion
+        if strategy == 0:
+            if accumulator == 0:
+                return ii + 1
+        elif (ii + 1) % n_coordinates == 0 and accumulator <= tol:
+            return ii + 1
+
+        # increment to next segment
+        i_seg += 1
+        t_start_seg += n_times_seg
+        t_end_seg += n_times_seg
+        if t_start_seg >= n_times_valid:
+            i_seg = 0
+            t_start_seg, t_end_seg = 0, n_times_seg
+
+    return max_iter
@@ -82,14 +82,17 @@ def _patch_reconstruction_error(X, z, D):
     *_, n_times_atom = get_D_shape(D, n_channels)
 
     from .convolution import construct_X_multi
-    X_hat = construct_X_multi(z, D, n_channels=n_channels)
 
-    diff = (X - X_hat)**2
-    patch = np.ones(n_times_atom)
+    # Sum the squared error over the channels, one trial at a time to avoid
+    # reconstructing the full signal, and compute the sum over each window of
+    # size n_times_atom with a cumulative sum.
+    diff = np.array([
+        ((X[i] - construct_X_multi(z[i:i + 1], D, n_channels=n_channels)[0])
+         ** 2).sum(axis=0) for i in range(X.shape[0])
+    ])
+    cum_diff = np.cumsum(np.pad(diff, ((0, 0), (1, 0))), axis=1)
 
-    return np.sum([[np.convolve(patch, diff_ip, mode='valid')
-                    for diff_ip in diff_i]
-                   for diff_i in diff], axis=1)
+    return cum_diff[:, n_times_atom:] - cum_diff[:, :-n_times_atom]
 
 
 def get_lambda_max(X, D_hat, sample_weights=None):
@@ -110,13 +113,16 @@ def get_lambda_max(X, D_hat, sample_weights=None):
         else:
             sample_weights = np.ones((n_trials, n_channels))
 
+    # The maximum is taken for each trial, to only hold the correlation of
+    # one atom with one trial in memory.
+
     # multivariate rank-1 case
     if D_hat.ndim == 2:
         return np.max([[
             np.convolve(
                 np.dot(uv_k[:n_channels], X_i * W_i), uv_k[:n_channels - 1:-1],
-                mode='valid') for X_i, W_i in zip(X, sample_weights)
-        ] for uv_k in D_hat], axis=(1, 2))[:, None]
+                mode='valid').max() for X_i, W_i in zip(X, sample_weights)
+        ] for uv_k in D_hat], axis=1)[:, None]
 
     # multivariate general case
     else:
@@ -124,8 +130,8 @@ def get_lambda_max(X, D_hat, sample_weights=None):
             np.sum([
                 np.correlate(D_kp, X_ip * W_ip, mode='valid')
                 for D_kp, X_ip, W_ip in zip(D_k, X_i, W_i)
-            ], axis=0) for X_i, W_i in zip(X, sample_weights)
-        ] for D_k in D_hat], axis=(1, 2))[:, None]
+            ], axis=0).max() for X_i, W_i in zip(X, sample_weights)
+        ] for D_k in D_hat], axis=1)[:, None]
 
 
 class NoWindow():
@@ -0,0 +1,52 @@
+"""Control of the threads used by the multi-threaded numba kernels."""
+from contextlib import contextmanager
+
+import numba
+from joblib import effective_n_jobs
+
+
+_NUMBA_PARALLEL = True
+
+
+def set_numba_parallel(enabled):
+    """Enable or disable the multi-threaded numba kernels.
+
+    When disabled, DtD, ztz, ztX and the rank-1 convolution of the D-step
+    are computed with their single-threaded kernels, whatever the number
+    of threads set with ``numba_threads``. This is useful when alphacsc is
+    itself run in several processes or threads.
+
+    Parameters
+    ----------
+    enabled : bool
+        If True, the kernels use the numba threads.
+    """
+    global _NUMBA_PARALLEL
+    _NUMBA_PARALLEL = bool(enabled)
+
+
+def get_numba_n_threads():
+    """Number of threads used by the multi-threaded numba kernels."""
+    if not _NUMBA_PARALLEL:
+        return 1
+    return numba.get_num_threads()
+
+
+@contextmanager
+def numba_threads(n_jobs=1):
+    """Context manager setting the number of numba threads from n_jobs.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of threads used by the numba kernels, with the joblib
+        convention (-1 means all the cores). It is clipped to the number
+        of threads numba was started with (NUMBA_NUM_THREADS).
+    """
+    n_threads = min(effective_n_jobs(n_jobs), numba.config.NUMBA_NUM_THREADS)
+    previous_n_threads = numba.get_num_threads()
+    numba.set_num_threads(max(1, n_threads))
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous_n_threads)
@@ -0,0 +1,94 @@
+"""Duality gap and gap safe screening for the convolutional Lasso.
+
+The z-step of one trial solves the non-negative convolutional Lasso
+
+    min_{z >= 0} 1/2 ||X - D z||^2 + sum_k reg_k sum_t z[k, t]
+
+whose dual problem is
+
+    max_theta 1/2 ||X||^2 - 1/2 ||X - theta||^2
+    s.t. (D^T theta)[k, t] <= reg_k for all (k, t).
+
+From a primal point z, the residual theta = X - D z rescaled to be dual
+feasible gives the duality gap. The optimal dual point is in the ball of
+radius sqrt(2 * gap) around theta, so the coordinates with
+(D^T theta)[k, t] + sqrt(2 * gap) ||d_k|| < reg_k are zero at the optimum
+(Fercoq et al., 2015). All the quantities are derived from the gradient
+D^T (D z - X), which the solvers already compute, and from D^T X and
+||X||^2 computed once per trial.
+"""
+import numpy as np
+
+from ..loss_and_gradient import gradient_zi
+
+
+def compute_DtX(Xi, D):
+    """Compute the correlation D^T X of one trial with the atoms.
+
+    Returns
+    -------
+    DtX : array, shape (n_atoms, n_times_valid)
+    """
+    n_channels, n_times = Xi.shape
+    n_times_atom = D.shape[-1] - n_channels if D.ndim == 2 else D.shape[-1]
+    z = np.zeros((D.shape[0], n_times - n_times_atom + 1), dtype=Xi.dtype)
+    return -gradient_zi(Xi, z, D=D)
+
+
+def compute_dual_gap(z, grad, DtX, XtX, reg):
+    """Compute the duality gap of the z-step of one trial.
+
+    Parameters
+    ----------
+    z : array, shape (n_atoms, n_times_valid)
+        The current codes, which should be non-negative.
+    grad : array, shape (n_atoms, n_times_valid)
+        The gradient D^T (D z - X) of the data fit in z.
+    DtX : array, shape (n_atoms, n_times_valid)
+        The correlation of the signal with the atoms, see compute_DtX.
+    XtX : float
+        The squared norm of the signal.
+    reg : float or array, shape (n_atoms, 1)
+        The regularization parameter. It should be positive.
+
+    Returns
+    -------
+    gap : float
+        The duality gap.
+    dual_scale : float
+        The factor dividing the residual X - D z to get the dual point.
+    """
+    reg = np.reshape(np.asarray(reg, dtype=np.float64), (-1, 1))
+    z_DtX = np.dot(z.ravel(), DtX.ravel().astype(np.float64))
+    residual_norm2 = XtX - z_DtX + np.dot(z.ravel(),
+                                          grad.ravel().astype(np.float64))
+    X_residual = XtX - z_DtX
+
+    dual_scale = max(1., np.max(-grad / reg))
+    primal = .5 * residual_norm2 + np.sum(reg * z.sum(axis=1, keepdims=True))
+    dual = X_residual / dual_scale - .5 * residual_norm2 / dual_scale ** 2
+    return primal - dual, dual_scale
+
+
+def gap_safe_screening(z, grad, DtX, XtX, reg, norm_Dk):
+    """Find the coordinates that are zero at the optimum of the z-step.
+
+    Parameters
+    ----------
+    z, grad, DtX, XtX, reg :
+        See compute_dual_gap.
+    norm_Dk : array, shape (n_atoms, 1)
+        The squared norms of the atoms.
+
+    Returns
+    -------
+    screened : array of bool, shape (n_atoms, n_times_valid)
+        True for the coordinates that can be set to zero.
+    gap : float
+        The duality gap at z.
+    """
+    gap, dual_scale = compute_dual_gap(z, grad, DtX, XtX, reg)
+    radius = np.sqrt(2 * max(gap, 0.))
+    reg = np.reshape(reg, (-1, 1))
+    screened = -grad / dual_scale + radius * np.sqrt(norm_Dk) < reg
+    return screened, gap
@@ -1,9 +1,19 @@
+import numba
 import numpy as np
-
+import pytest
+from scipy import sparse
 
 from alphacsc.utils import check_random_state, get_D
 from alphacsc.utils.compute_constants import compute_DtD, compute_ztz
+from alphacsc.utils.compute_constants import compute_ztX
+from alphacsc.utils.compute_constants import _compute_DtD_D_parallel
+from alphacsc.utils.compute_constants import _compute_DtD_uv_parallel
+from alphacsc.utils.compute_constants import _compute_ztz_dense_parallel
 from alphacsc.utils.convolution import tensordot_convolve, construct_X_multi
+from alphacsc.utils.convolution import numpy_convolve_uv
+from alphacsc.utils.convolution import _numpy_convolve_uv_parallel
+from alphacsc.utils.parallel import get_numba_n_threads, numba_threads
+from alphacsc.utils.parallel import set_numba_parallel
 
 
 def test_DtD():
@@ -41,3 +51,117 @@ def test_ztz():
     X_hat = construct_X_multi(z, D)
 
     assert np.isclose(cost, np.dot(X_hat.ravel(), X_hat.ravel()))
+
+
+def test_ztz_ztX_sparse():
+    n_atoms = 7
+    n_trials = 3
+    n_channels = 5
+    n_times_valid = 500
+    n_times_atom = 10
+
+    rng = check_random_state(42)
+
+    z = rng.randn(n_trials, n_atoms, n_times_valid)
+    z[abs(z) < 1.5] = 0
+    X = rng.randn(n_trials, n_channels, n_times_valid + n_times_atom - 1)
+    z_sparse = [sparse.csr_matrix(z_i) for z_i in z]
+
+    assert np.allclose(compute_ztz(z_sparse, n_times_atom),
+                       compute_ztz(z, n_times_atom))
+    assert np.allclose(compute_ztX(z_sparse, X), compute_ztX(z, X))
+
+    D = rng.randn(n_atoms, n_channels, n_times_atom)
+    assert np.allclose(construct_X_multi(z_sparse, D),
+                       construct_X_multi(z, D))
+    uv = rng.randn(n_atoms, n_channels + n_times_atom)
+    assert np.allclose(construct_X_multi(z_sparse, uv, n_channels=n_channels),
+                       construct_X_multi(z, uv, n_channels=n_channels))
+
+
+@pytest.mark.parametrize('n_times_atom', [1, 7])
+@pytest.mark.parametrize('density', [0.01, 0.3, 1])
+def test_ztz_ztX_methods(n_times_atom, density):
+    rng = np.random.RandomState(0)
+    n_trials, n_atoms, n_channels, n_times_valid = 3, 4, 2, 100
+    n_times = n_times_valid + n_times_atom - 1
+    z = rng.randn(n_trials, n_atoms, n_times_valid)
+    z *= rng.rand(n_trials, n_atoms, n_times_valid) < density
+    z_sparse = [sparse.csr_matrix(z_i) for z_i in z]
+    X = rng.randn(n_trials, n_channels, n_times)
+
+    # reference with explicit loops over the activations
+    ztz_ref = np.zeros((n_atoms, n_atoms, 2 * n_times_atom - 1))
+    ztX_ref = np.zeros((n_atoms, n_channels, n_times_atom))
+    t0 = n_times_atom - 1
+    for i, k0, s in zip(*z.nonzero()):
+        ztX_ref[k0] += z[i, k0, s] * X[i, :, s:s + n_times_atom]
+        for k in range(n_atoms):
+            for t in range(-t0, n_times_atom):
+                if 0 <= s + t < n_times_valid:
+                    ztz_ref[k0, k, t0 + t] += z[i, k0, s] * z[i, k, s + t]
+
+    for method in ['auto', 'sparse', 'fft', 'dense']:
+        assert np.allclose(compute_ztz(z, n_times_atom, method=method),
+                           ztz_ref)
+    for method in ['auto', 'sparse', 'fft']:
+        assert np.allclose(compute_ztz(z_sparse, n_times_atom,
+                                       method=method), ztz_ref)
+        assert np.allclose(compute_ztX(z, X, method=method), ztX_ref)
+        assert np.allclose(compute_ztX(z_sparse, X, method=method), ztX_ref)
+
+    # float32 codes and signals are accumulated in float64 with all methods
+    z32, X32 = z.astype(np.float32), X.astype(np.float32)
+    z32_sparse = [sparse.csr_matrix(z_i) for z_i in z32]
+    ztz_ref32 = compute_ztz(z32.astype(np.float64), n_times_atom,
+                            method='dense')
+    ztX_ref32 = compute_ztX(z32.astype(np.float64), X32.astype(np.float64),
+                            method='sparse')
+    for method in ['auto', 'sparse', 'fft', 'dense']:
+        ztz = compute_ztz(z32, n_times_atom, method=method)
+        assert ztz.dtype == np.float64
+        assert np.allclose(ztz, ztz_ref32, rtol=1e-12, atol=1e-12)
+    for method in ['auto', 'sparse', 'fft']:
+        for z_i in [z32, z32_sparse]:
+            ztX = compute_ztX(z_i, X32, method=method)
+            assert ztX.dtype == np.float64
+            assert np.allclose(ztX, ztX_ref32, rtol=1e-12, atol=1e-12)
+
+    with pytest.raises(ValueError, match="Unknown method"):
+        compute_ztz(z, n_times_atom, method='foo')
+
+
+@pytest.mark.parametrize('rank1', [False, True])
+def test_parallel_kernels(rank1):
+    rng = np.random.RandomState(0)
+    n_trials, n_atoms, n_channels, n_times_atom = 2, 5, 3, 7
+    z = rng.randn(n_trials, n_atoms, 50)
+    uv = rng.randn(n_atoms, n_channels + n_times_atom)
+    D = uv if rank1 else get_D(uv, n_channels)
+
+    DtD = compute_DtD(D, n_channels=n_channels)
+    ztz = compute_ztz(z, n_times_atom, method='dense')
+    G = numpy_convolve_uv(ztz, uv)
+    if rank1:
+        DtD_parallel = _compute_DtD_uv_parallel(D, n_channels)
+    else:
+        DtD_parallel = _compute_DtD_D_parallel(D)
+    assert np.allclose(DtD_parallel, DtD)
+    assert np.allclose(_compute_ztz_dense_parallel(z, n_times_atom), ztz)
+    assert np.allclose(_numpy_convolve_uv_parallel(ztz, uv), G)
+    assert np.allclose(G, tensordot_convolve(ztz, get_D(uv, n_channels)))
+
+    n_threads = numba.get_num_threads()
+    with numba_threads(n_jobs=2):
+        assert numba.get_num_threads() == min(2,
+                                              numba.config.NUMBA_NUM_THREADS)
+        assert np.allclose(compute_DtD(D, n_channels=n_channels), DtD)
+        assert np.allclose(compute_ztz(z, n_times_atom, method='dense'), ztz)
+        assert np.allclose(numpy_convolve_uv(ztz, uv), G)
+
+        set_numba_parallel(False)
+        try:
+            assert get_numba_n_threads() == 1
+        finally:
+            set_numba_parallel(True)
+    assert numba.get_num_threads() == n_threads
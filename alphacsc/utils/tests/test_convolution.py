@@ -0,0 +1,50 @@
+import pytest
+import numpy as np
+
+from alphacsc.utils import check_random_state
+from alphacsc.utils.convolution import _dense_convolve_multi
+from alphacsc.utils.convolution import _dense_convolve_multi_uv
+from alphacsc.utils.convolution import _fft_convolve_multi
+from alphacsc.utils.convolution import _fft_transpose_convolve_d
+from alphacsc.utils.convolution import _get_convolve_method
+from alphacsc.loss_and_gradient import _dense_transpose_convolve_d
+
+
+@pytest.mark.parametrize('rank1', [True, False])
+def test_fft_convolve(rank1):
+    n_atoms, n_channels, n_times_atom, n_times_valid = 4, 3, 20, 300
+
+    rng = check_random_state(42)
+    z_i = rng.randn(n_atoms, n_times_valid)
+    if rank1:
+        D = rng.randn(n_atoms, n_channels + n_times_atom)
+        Xi = _dense_convolve_multi_uv(z_i, D, n_channels)
+    else:
+        D = rng.randn(n_atoms, n_channels, n_times_atom)
+        Xi = _dense_convolve_multi(z_i, D)
+
+    assert np.allclose(_fft_convolve_multi(z_i, D, n_channels), Xi)
+
+    residual_i = rng.randn(*Xi.shape)
+    assert np.allclose(
+        _fft_transpose_convolve_d(residual_i, D, n_channels),
+        _dense_transpose_convolve_d(residual_i, D, n_channels)
+    )
+
+
+def test_get_convolve_method():
+    # very sparse activations
+    assert _get_convolve_method(
+        10, n_atoms=10, n_channels=5, n_times_valid=10000, n_times_atom=64,
+        rank1=False) == 'sparse'
+    # short signals and atoms
+    assert _get_convolve_method(
+        500, n_atoms=5, n_channels=1, n_times_valid=500, n_times_atom=10,
+        rank1=False) == 'dense'
+    # long atoms and dense activations
+    assert _get_convolve_method(
+        20000, n_atoms=10, n_channels=20, n_times_valid=10000,
+        n_times_atom=200, rank1=False) == 'fft'
+    assert _get_convolve_method(
+        None, n_atoms=10, n_channels=20, n_times_valid=10000,
+        n_times_atom=200, rank1=False, transpose=True) == 'fft'
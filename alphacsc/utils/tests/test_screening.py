@@ -0,0 +1,95 @@
+import pytest
+import numpy as np
+
+from alphacsc.update_z_multi import update_z_multi
+from alphacsc.loss_and_gradient import gradient_zi
+from alphacsc.utils.dictionary import get_lambda_max
+from alphacsc.utils.screening import (compute_DtX, compute_dual_gap,
+                                      gap_safe_screening)
+
+
+@pytest.mark.parametrize('rank1', [True, False])
+@pytest.mark.parametrize('per_atom', [False, True])
+def test_gap_safe_screening(rank1, per_atom):
+    n_channels, n_times, n_times_atom, n_atoms = 3, 200, 10, 4
+    rng = np.random.RandomState(0)
+    X = rng.randn(1, n_channels, n_times)
+    if rank1:
+        D = rng.randn(n_atoms, n_channels + n_times_atom)
+        norm_Dk = (np.sum(D[:, :n_channels] ** 2, axis=1)
+                   * np.sum(D[:, n_channels:] ** 2, axis=1))[:, None]
+    else:
+        D = rng.randn(n_atoms, n_channels, n_times_atom)
+        norm_Dk = np.sum(D ** 2, axis=(1, 2))[:, None]
+    reg = .3 * get_lambda_max(X, D)
+    if not per_atom:
+        reg = reg.max()
+
+    XtX = np.sum(X * X)
+    DtX = compute_DtX(X[0], D)
+    assert np.allclose(DtX, -gradient_zi(X[0], np.zeros_like(DtX), D=D))
+
+    z_star, _, _ = update_z_multi(X, D, reg, solver='lgcd',
+                                  solver_kwargs=dict(tol=1e-10))
+    z_star = z_star[0]
+
+    def gap_and_screening(z):
+        grad = gradient_zi(X[0], z, D=D)
+        gap, _ = compute_dual_gap(z, grad, DtX, XtX, reg)
+        screened, gap_ = gap_safe_screening(z, grad, DtX, XtX, reg, norm_Dk)
+        assert gap == gap_
+        return gap, screened
+
+    # the gap is zero at the optimum, where the screening is the tightest
+    gap, screened = gap_and_screening(z_star)
+    assert abs(gap) < 1e-6 * XtX
+    assert np.all(z_star[screened] == 0)
+    assert screened.mean() > .5
+
+    # for any feasible point, the gap is positive and the screened
+    # coordinates are zero at the optimum
+    for z in [np.zeros_like(z_star), z_star * (1 + rng.rand(*z_star.shape)),
+              abs(rng.randn(*z_star.shape)) * (rng.rand(*z_star.shape) > .9)]:
+        gap, screened = gap_and_screening(z)
+        assert gap > 0
+        assert np.all(z_star[screened] == 0)
+
+
+@pytest.mark.parametrize('solver, solver_kwargs', [
+    ('lgcd', dict()), ('lgcd', dict(use_numba=True)),
+    ('lgcd', dict(strategy='cyclic', use_numba=True)),
+    ('fista', dict(max_iter=1000))])
+@pytest.mark.parametrize('freeze_support', [False, True])
+def test_update_z_multi_screening(solver, solver_kwargs, freeze_support):
+    n_trials, n_channels, n_times = 2, 3, 200
+    n_times_atom, n_atoms = 10, 4
+    n_times_valid = n_times - n_times_atom + 1
+
+    rng = np.random.RandomState(0)
+    X = rng.randn(n_trials, n_channels, n_times)
+    D = rng.randn(n_atoms, n_channels + n_times_atom)
+    reg = .3 * get_lambda_max(X, D).max()
+    z0 = abs(rng.randn(n_trials, n_atoms, n_times_valid))
+    z0[z0 < 1] = 0
+
+    kwargs = dict(z0=z0, solver=solver, freeze_support=freeze_support,
+                  return_ztz=True, return_stats=True)
+    z_hat, ztz, ztX, stats = update_z_multi(
+        X, D, reg, solver_kwargs=dict(solver_kwargs, screen_every=2),
+        **kwargs)
+    assert all(stats_i == {} for stats_i in stats)
+    z_screen, ztz_screen, ztX_screen, stats = update_z_multi(
+        X, D, reg, solver_kwargs=dict(solver_kwargs, screening=True,
+                                      screen_every=2), **kwargs)
+    assert np.allclose(z_screen, z_hat, atol=1e-6)
+    assert np.allclose(ztz_screen, ztz, atol=1e-6)
+    assert np.allclose(ztX_screen, ztX, atol=1e-6)
+    for stats_i in stats:
+        assert stats_i['n_coordinates'] == n_atoms * n_times_valid
+        assert 0 < stats_i['n_screened'] < stats_i['n_coordinates']
+        assert stats_i['gap'] >= 0
+
+    # the screening is disabled without regularization
+    *_, stats = update_z_multi(
+        X, D, 0, solver_kwargs=dict(solver_kwargs, screening=True), **kwargs)
+    assert all('n_screened' not in stats_i for stats_i in stats)
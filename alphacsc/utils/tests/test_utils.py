@@ -45,7 +45,7 @@ def test_construct_X():
     X_uv = construct_X_multi(zi, D=uv, n_channels=n_channels)
     X_ds = construct_X_multi(zi, D=ds)
 
-    assert_allclose(X_uv, X_ds, atol=1e-16)
+    assert_allclose(X_uv, X_ds, atol=1e-12)
 
 
 def test_uv_D():
@@ -7,6 +7,8 @@ from joblib import Memory
 import matplotlib.pyplot as plt
 from scipy.stats.mstats import gmean
 
+from alphacsc.utils.compute_constants import compute_ztX as _compute_ztX
+
 memory = Memory(location='', verbose=0)
 
 
@@ -27,8 +29,23 @@ def compute_ztX(z, X):
     return ztX
 
 
+def sparse_ztX(z, X):
+    return _compute_ztX(z.swapaxes(0, 1), X, method='sparse')
+
+
+def fft_ztX(z, X):
+    return _compute_ztX(z.swapaxes(0, 1), X, method='fft')
+
+
+def auto_ztX(z, X):
+    return _compute_ztX(z.swapaxes(0, 1), X, method='auto')
+
+
 all_func = [
     compute_ztX,
+    sparse_ztX,
+    fft_ztX,
+    auto_ztX,
 ]
 
 
@@ -69,6 +86,9 @@ def benchmark():
     n_times_atom_range = [10, 40, 160]
     n_times_valid_range = [200, 800, 3200]
 
+    # compile the numba kernels before timing them
+    test_equality()
+
     n_runs = (len(n_atoms_range) * len(sparsity_range) * len(
         n_times_atom_range) * len(n_times_valid_range) * len(all_func))
 
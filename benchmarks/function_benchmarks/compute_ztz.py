@@ -8,6 +8,8 @@ from joblib import Memory
 import matplotlib.pyplot as plt
 from scipy.stats.mstats import gmean
 
+from alphacsc.utils.compute_constants import compute_ztz
+
 memory = Memory(location='', verbose=0)
 
 
@@ -82,10 +84,25 @@ def tensordot(z, n_times_atom):
     return ztz
 
 
+def sparse_ztz(z, n_times_atom):
+    return compute_ztz(z.swapaxes(0, 1), n_times_atom, method='sparse')
+
+
+def fft_ztz(z, n_times_atom):
+    return compute_ztz(z.swapaxes(0, 1), n_times_atom, method='fft')
+
+
+def auto_ztz(z, n_times_atom):
+    return compute_ztz(z.swapaxes(0, 1), n_times_atom, method='auto')
+
+
 all_func = [
     # naive_sum,
     sum_numba,
     tensordot,
+    sparse_ztz,
+    fft_ztz,
+    auto_ztz,
 ]
 
 
@@ -119,6 +136,9 @@ def benchmark():
     n_times_atom_range = [8, 32, 128]
     n_times_valid_range = [1000, 30000, 10000]
 
+    # compile the numba kernels before timing them
+    test_equality()
+
     n_runs = (len(n_atoms_range) * len(sparsity_range) * len(
         n_times_atom_range) * len(n_times_valid_range) * len(all_func))
 
@@ -0,0 +1,113 @@
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from joblib import Memory
+import matplotlib.pyplot as plt
+from scipy.stats.mstats import gmean
+
+from alphacsc.utils.convolution import _sparse_convolve_multi
+from alphacsc.utils.convolution import _dense_convolve_multi
+from alphacsc.utils.convolution import _fft_convolve_multi
+from alphacsc.utils.convolution import _choose_convolve_multi
+
+memory = Memory(location='', verbose=0)
+
+
+def sparse_convolve(z_i, D):
+    return _sparse_convolve_multi(z_i, D)
+
+
+def dense_convolve(z_i, D):
+    return _dense_convolve_multi(z_i, D)
+
+
+def fft_convolve(z_i, D):
+    return _fft_convolve_multi(z_i, D)
+
+
+def auto_convolve(z_i, D):
+    return _choose_convolve_multi(z_i, D)
+
+
+all_func = [
+    sparse_convolve,
+    dense_convolve,
+    fft_convolve,
+    auto_convolve,
+]
+
+
+def test_equality():
+    n_atoms, n_channels, n_times_atom, n_times_valid = 5, 3, 64, 1000
+    z_i = np.random.randn(n_atoms, n_times_valid)
+    D = np.random.randn(n_atoms, n_channels, n_times_atom)
+
+    reference = all_func[0](z_i, D)
+    for func in all_func:
+        assert np.allclose(func(z_i, D), reference)
+
+
+@memory.cache
+def run_one(n_atoms, n_channels, n_times_atom, n_times_valid, sparsity,
+            func):
+    z_i = sparse.random(n_atoms, n_times_valid, density=sparsity).toarray()
+    D = np.random.randn(n_atoms, n_channels, n_times_atom)
+
+    start = time.time()
+    func(z_i, D)
+    duration = time.time() - start
+    return (n_atoms, n_channels, n_times_atom, n_times_valid, sparsity,
+            func.__name__, duration)
+
+
+def benchmark():
+    n_atoms = 10
+    n_channels_range = [1, 5, 20]
+    n_times_atom_range = [16, 64, 128, 256]
+    n_times_valid_range = [1000, 10000, 100000]
+    sparsity_range = [0.001, 0.01, 0.1]
+
+    n_runs = (len(n_channels_range) * len(n_times_atom_range) *
+              len(n_times_valid_range) * len(sparsity_range) * len(all_func))
+
+    k = 0
+    results = []
+    for n_channels in n_channels_range:
+        for n_times_atom in n_times_atom_range:
+            for n_times_valid in n_times_valid_range:
+                for sparsity in sparsity_range:
+                    for func in all_func:
+                        print('%d/%d, %s' % (k, n_runs, func.__name__))
+                        k += 1
+                        results.append(
+                            run_one(n_atoms, n_channels, n_times_atom,
+                                    n_times_valid, sparsity, func))
+
+    df = pd.DataFrame(results, columns=[
+        'n_atoms', 'n_channels', 'n_times_atom', 'n_times_valid', 'sparsity',
+        'func', 'duration'
+    ])
+    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+    axes = axes.ravel()
+
+    def plot(index, ax):
+        pivot = df.pivot_table(columns='func', index=index, values='duration',
+                               aggfunc=gmean)
+        pivot.plot(ax=ax)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_ylabel('duration')
+
+    plot('n_channels', axes[0])
+    plot('n_times_atom', axes[1])
+    plot('n_times_valid', axes[2])
+    plot('sparsity', axes[3])
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == '__main__':
+    test_equality()
+    benchmark()
@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Memory
+import matplotlib.pyplot as plt
+from scipy.stats.mstats import gmean
+
+from alphacsc import BatchCDL
+
+memory = Memory(location='', verbose=0)
+
+
+def _fit(X, n_atoms, n_times_atom, solver_z, dtype):
+    cdl = BatchCDL(n_atoms, n_times_atom, n_iter=20, eps=-np.inf,
+                   reg=.2, solver_z=solver_z, random_state=0, verbose=0,
+                   dtype=dtype)
+    cdl.fit(X)
+    return cdl.pobj_[-1]
+
+
+def lgcd_float64(X, n_atoms, n_times_atom):
+    return _fit(X, n_atoms, n_times_atom, 'lgcd', np.float64)
+
+
+def lgcd_float32(X, n_atoms, n_times_atom):
+    return _fit(X, n_atoms, n_times_atom, 'lgcd', np.float32)
+
+
+def lbfgs_float64(X, n_atoms, n_times_atom):
+    return _fit(X, n_atoms, n_times_atom, 'l-bfgs', np.float64)
+
+
+def lbfgs_float32(X, n_atoms, n_times_atom):
+    return _fit(X, n_atoms, n_times_atom, 'l-bfgs', np.float32)
+
+
+all_func = [
+    lgcd_float64,
+    lgcd_float32,
+    lbfgs_float64,
+    lbfgs_float32,
+]
+
+
+def test_equality():
+    rng = np.random.RandomState(0)
+    X = rng.randn(2, 3, 1000)
+
+    for func_64, func_32 in zip(all_func[::2], all_func[1::2]):
+        reference = func_64(X, 5, 20)
+        assert np.isclose(func_32(X, 5, 20), reference, rtol=1e-4)
+
+
+@memory.cache
+def run_one(n_atoms, n_channels, n_times_atom, n_times, func):
+    rng = np.random.RandomState(0)
+    X = rng.randn(4, n_channels, n_times)
+
+    start = time.time()
+    pobj = func(X, n_atoms, n_times_atom)
+    duration = time.time() - start
+    return (n_atoms, n_times_atom, n_times, func.__name__, duration, pobj)
+
+
+def benchmark():
+    n_channels = 5
+    n_atoms_range = [5, 10, 20]
+    n_times_atom_range = [16, 64]
+    n_times_range = [2000, 10000, 50000]
+
+    # compile the numba kernels before timing them
+    test_equality()
+
+    results = []
+    for n_atoms in n_atoms_range:
+        for n_times_atom in n_times_atom_range:
+            for n_times in n_times_range:
+                for func in all_func:
+                    print(n_atoms, n_times_atom, n_times, func.__name__)
+                    results.append(run_one(n_atoms, n_channels, n_times_atom,
+                                           n_times, func))
+
+    df = pd.DataFrame(results, columns=[
+        'n_atoms', 'n_times_atom', 'n_times', 'func', 'duration', 'pobj'
+    ])
+
+    # relative degradation of the final objective w.r.t. float64
+    df['solver'] = df['func'].str.split('_').str[0]
+    keys = ['n_atoms', 'n_times_atom', 'n_times', 'solver']
+    reference = df[df['func'].str.endswith('float64')].set_index(keys)['pobj']
+    df['pobj_degradation'] = abs(
+        df['pobj'].values / reference.loc[
+            pd.MultiIndex.from_frame(df[keys])].values - 1) + 1e-16
+    print(df.pivot_table(columns='func', index='n_times',
+                         values=['duration', 'pobj_degradation'],
+                         aggfunc=gmean))
+
+    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+    axes = axes.ravel()
+
+    def plot(index, values, ax):
+        pivot = df.pivot_table(columns='func', index=index, values=values,
+                               aggfunc=gmean)
+        pivot.plot(ax=ax)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_ylabel(values)
+
+    plot('n_atoms', 'duration', axes[0])
+    plot('n_times_atom', 'duration', axes[1])
+    plot('n_times', 'duration', axes[2])
+    plot('n_times', 'pobj_degradation', axes[3])
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == '__main__':
+    test_equality()
+    benchmark()
@@ -0,0 +1,107 @@
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Memory
+import matplotlib.pyplot as plt
+from scipy.stats.mstats import gmean
+
+from alphacsc._z_encoder import get_z_encoder_for
+from alphacsc.utils.dictionary import get_lambda_max
+
+memory = Memory(location='', verbose=0)
+
+
+def get_cost_statistics(z_encoder):
+    return z_encoder.get_cost()
+
+
+def get_cost_reconstruction(z_encoder):
+    z_hat_stats = z_encoder._z_hat_stats
+    z_encoder._z_hat_stats = None
+    try:
+        return z_encoder.get_cost()
+    finally:
+        z_encoder._z_hat_stats = z_hat_stats
+
+
+all_func = [
+    get_cost_reconstruction,
+    get_cost_statistics,
+]
+
+
+def _get_z_encoder(n_trials, n_atoms, n_channels, n_times_atom, n_times,
+                   reg_ratio):
+    rng = np.random.RandomState(0)
+    X = rng.randn(n_trials, n_channels, n_times)
+    D = rng.randn(n_atoms, n_channels + n_times_atom)
+    D /= np.linalg.norm(D, axis=1, keepdims=True)
+    reg = reg_ratio * get_lambda_max(X, D).max()
+
+    z_encoder = get_z_encoder_for(X, D, n_atoms, n_times_atom, 1, 'lgcd',
+                                  dict(), reg)
+    z_encoder.compute_z()
+    return z_encoder
+
+
+def test_equality():
+    z_encoder = _get_z_encoder(2, 5, 3, 20, 1000, .1)
+
+    reference = all_func[0](z_encoder)
+    for func in all_func:
+        assert np.isclose(func(z_encoder), reference)
+
+
+@memory.cache
+def run_one(n_atoms, n_channels, n_times_atom, n_times, func):
+    z_encoder = _get_z_encoder(4, n_atoms, n_channels, n_times_atom, n_times,
+                               .1)
+
+    start = time.time()
+    func(z_encoder)
+    duration = time.time() - start
+    return (n_atoms, n_times_atom, n_times, func.__name__, duration)
+
+
+def benchmark():
+    n_channels = 5
+    n_atoms_range = [5, 10, 20]
+    n_times_atom_range = [16, 64, 128]
+    n_times_range = [2000, 10000, 50000]
+
+    # compile the numba kernels before timing them
+    test_equality()
+
+    results = []
+    for n_atoms in n_atoms_range:
+        for n_times_atom in n_times_atom_range:
+            for n_times in n_times_range:
+                for func in all_func:
+                    print(n_atoms, n_times_atom, n_times, func.__name__)
+                    results.append(run_one(n_atoms, n_channels, n_times_atom,
+                                           n_times, func))
+
+    df = pd.DataFrame(results, columns=[
+        'n_atoms', 'n_times_atom', 'n_times', 'func', 'duration'
+    ])
+    fig, axes = plt.subplots(1, 3, figsize=(12, 4))
+
+    def plot(index, ax):
+        pivot = df.pivot_table(columns='func', index=index, values='duration',
+                               aggfunc=gmean)
+        pivot.plot(ax=ax)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_ylabel('duration')
+
+    plot('n_atoms', axes[0])
+    plot('n_times_atom', axes[1])
+    plot('n_times', axes[2])
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == '__main__':
+    test_equality()
+    benchmark()
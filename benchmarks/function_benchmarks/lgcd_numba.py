@@ -0,0 +1,102 @@
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Memory
+import matplotlib.pyplot as plt
+from scipy.stats.mstats import gmean
+
+from alphacsc.utils.dictionary import get_lambda_max
+from alphacsc.update_z_multi import update_z_multi
+
+memory = Memory(location='', verbose=0)
+
+
+def lgcd_python(X, D, reg):
+    return update_z_multi(X, D, reg, solver='lgcd',
+                          solver_kwargs=dict(use_numba=False))[0]
+
+
+def lgcd_numba(X, D, reg):
+    return update_z_multi(X, D, reg, solver='lgcd',
+                          solver_kwargs=dict(use_numba=True))[0]
+
+
+all_func = [
+    lgcd_python,
+    lgcd_numba,
+]
+
+
+def test_equality():
+    rng = np.random.RandomState(0)
+    X = rng.randn(2, 3, 1000)
+    D = rng.randn(5, 3 + 20)
+    reg = .1 * get_lambda_max(X, D).max()
+
+    reference = all_func[0](X, D, reg)
+    for func in all_func:
+        assert np.array_equal(func(X, D, reg), reference)
+
+
+@memory.cache
+def run_one(n_atoms, n_channels, n_times_atom, n_times, reg_ratio, func):
+    rng = np.random.RandomState(0)
+    X = rng.randn(1, n_channels, n_times)
+    D = rng.randn(n_atoms, n_channels + n_times_atom)
+    reg = reg_ratio * get_lambda_max(X, D).max()
+
+    start = time.time()
+    func(X, D, reg)
+    duration = time.time() - start
+    return (n_atoms, n_times_atom, n_times, reg_ratio, func.__name__,
+            duration)
+
+
+def benchmark():
+    n_channels = 5
+    n_atoms_range = [5, 10, 20]
+    n_times_atom_range = [16, 64, 128]
+    n_times_range = [2000, 10000]
+    reg_ratio_range = [0.1, 0.3]
+
+    # compile the numba kernel before timing it
+    test_equality()
+
+    results = []
+    for n_atoms in n_atoms_range:
+        for n_times_atom in n_times_atom_range:
+            for n_times in n_times_range:
+                for reg_ratio in reg_ratio_range:
+                    for func in all_func:
+                        print(n_atoms, n_times_atom, n_times, reg_ratio,
+                              func.__name__)
+                        results.append(run_one(
+                            n_atoms, n_channels, n_times_atom, n_times,
+                            reg_ratio, func))
+
+    df = pd.DataFrame(results, columns=[
+        'n_atoms', 'n_times_atom', 'n_times', 'reg_ratio', 'func', 'duration'
+    ])
+    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+    axes = axes.ravel()
+
+    def plot(index, ax):
+        pivot = df.pivot_table(columns='func', index=index, values='duration',
+                               aggfunc=gmean)
+        pivot.plot(ax=ax)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_ylabel('duration')
+
+    plot('n_atoms', axes[0])
+    plot('n_times_atom', axes[1])
+    plot('n_times', axes[2])
+    plot('reg_ratio', axes[3])
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == '__main__':
+    test_equality()
+    benchmark()